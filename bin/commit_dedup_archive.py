@@ -0,0 +1,21 @@
+import argparse
+import json
+
+from dedup_spectra import commit_archive
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add the signatures of a finished deposition to the duplicate archive.')
+    parser.add_argument('input_candidates', help='Candidate signatures from dedup_spectra.py --output_candidates')
+    parser.add_argument('archive', help='Path to the archive of previously deposited signatures')
+
+    args = parser.parse_args()
+
+    candidate_entries = json.load(open(args.input_candidates))
+    added_count = commit_archive(args.archive, candidate_entries)
+
+    print("Added {} of {} signatures to the archive {}".format(added_count, len(candidate_entries), args.archive))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import re
+import math
+import bisect
+
+# Scan names that carry a position, e.g. plate wells "B12" and imaging spots "R00X012Y034" or "x=12,y=34"
+WELL_PATTERN = re.compile(r'^\s*([A-Za-z]{1,2})\s*0*(\d+)\s*$')
+XY_PATTERN = re.compile(r'[Xx]\D{0,3}?(-?\d+(?:\.\d+)?)\D{0,3}?[Yy]\D{0,3}?(-?\d+(?:\.\d+)?)')
+PAIR_PATTERN = re.compile(r'^\s*\(?\s*(-?\d+(?:\.\d+)?)\s*[,;]\s*(-?\d+(?:\.\d+)?)\s*\)?\s*$')
+
+# load_data names the scans <id>_<index>, e.g. "B12_0"
+SCAN_INDEX_SUFFIX_PATTERN = re.compile(r'_\d+$')
+
+# Region queries that can be written in a Scan/Coordinate cell
+NUMBER = r'\s*(-?\d+(?:\.\d+)?)\s*'
+RECT_QUERY_PATTERN = re.compile(r'^\s*rect\(' + NUMBER + ',' + NUMBER + ',' + NUMBER + ',' + NUMBER + r'\)\s*$', re.I)
+CIRCLE_QUERY_PATTERN = re.compile(r'^\s*circle\(' + NUMBER + ',' + NUMBER + ',' + NUMBER + r'\)\s*$', re.I)
+WELL_RANGE_QUERY_PATTERN = re.compile(r'^\s*([A-Za-z]{1,2}\d+)\s*[:\-]\s*([A-Za-z]{1,2}\d+)\s*$')
+
+
+def _well_row(letters):
+    row = 0
+    for letter in letters.upper():
+        row = row * 26 + (ord(letter) - ord('A') + 1)
+    return row
+
+
+def _parse_position(scan_name):
+    well_match = WELL_PATTERN.match(scan_name)
+    if well_match:
+        return float(well_match.group(2)), float(_well_row(well_match.group(1)))
+
+    pair_match = PAIR_PATTERN.match(scan_name)
+    if pair_match:
+        return float(pair_match.group(1)), float(pair_match.group(2))
+
+    xy_match = XY_PATTERN.search(scan_name)
+    if xy_match:
+        return float(xy_match.group(1)), float(xy_match.group(2))
+
+    return None
+
+
+def parse_coordinate(scan_name):
+    """
+    Parses the position out of a scan name.
+
+    Wells are returned as (column, row) with A as row 1, so a well range is a rectangle.
+    The _<index> suffix that load_data appends to the scan id is ignored, e.g. "B12_0" is well B12.
+
+    Args:
+    scan_name: str, name of the scan
+
+    Returns:
+    position: tuple of (x, y) floats, or None if the scan name has no position
+    """
+    scan_name = str(scan_name)
+
+    position = _parse_position(scan_name)
+    if position is None and SCAN_INDEX_SUFFIX_PATTERN.search(scan_name):
+        position = _parse_position(SCAN_INDEX_SUFFIX_PATTERN.sub("", scan_name))
+
+    return position
+
+
+class CoordinateIndex:
+    """
+    Index over the scans of a file for Scan/Coordinate lookups.
+
+    Exact names are looked up in a dict. Positions are stored in a uniform grid, with the occupied
+    cells of every grid column kept sorted, so that region queries find the overlapping cells by
+    binary search instead of visiting every cell under the region or every occupied cell.
+    """
+
+    def __init__(self, scan_names, cell_size=1.0):
+        self.cell_size = cell_size
+        self.scan_order = {}
+        self.grid = {}
+
+        for scan_order, scan_name in enumerate(scan_names):
+            self.scan_order[scan_name] = scan_order
+
+            position = parse_coordinate(scan_name)
+            if position is None:
+                continue
+
+            self.grid.setdefault(self._cell(position), []).append((position, scan_name))
+
+        # Occupied cell rows of every occupied cell column, both sorted
+        self.column_rows = {}
+        for cell_x, cell_y in self.grid:
+            self.column_rows.setdefault(cell_x, []).append(cell_y)
+        for cell_rows in self.column_rows.values():
+            cell_rows.sort()
+        self.columns = sorted(self.column_rows)
+
+    def _cell(self, position):
+        return int(math.floor(position[0] / self.cell_size)), int(math.floor(position[1] / self.cell_size))
+
+    def _sorted(self, scan_names):
+        return sorted(scan_names, key=lambda scan_name: self.scan_order[scan_name])
+
+    def exact(self, scan_name):
+        """
+        Returns the scan name in a list if it is in the index, otherwise an empty list.
+        """
+        if scan_name in self.scan_order:
+            return [scan_name]
+        return []
+
+    def rectangle(self, x1, y1, x2, y2):
+        """
+        Returns the scan names with a position inside the rectangle, edges included.
+
+        Takes O(c log n + k) for c occupied cell columns across the rectangle and k scans in the overlapping cells.
+        """
+        min_x, max_x = min(x1, x2), max(x1, x2)
+        min_y, max_y = min(y1, y2), max(y1, y2)
+
+        min_cell = self._cell((min_x, min_y))
+        max_cell = self._cell((max_x, max_y))
+
+        all_cells = []
+        for column_index in range(bisect.bisect_left(self.columns, min_cell[0]), bisect.bisect_right(self.columns, max_cell[0])):
+            cell_x = self.columns[column_index]
+            cell_rows = self.column_rows[cell_x]
+            for row_index in range(bisect.bisect_left(cell_rows, min_cell[1]), bisect.bisect_right(cell_rows, max_cell[1])):
+                all_cells.append((cell_x, cell_rows[row_index]))
+
+        matched_scans = []
+        for cell in all_cells:
+            for position, scan_name in self.grid[cell]:
+                if min_x <= position[0] <= max_x and min_y <= position[1] <= max_y:
+                    matched_scans.append(scan_name)
+
+        return self._sorted(matched_scans)
+
+    def circle(self, x, y, radius):
+        """
+        Returns the scan names with a position within radius of (x, y).
+        """
+        matched_scans = []
+        for scan_name in self.rectangle(x - radius, y - radius, x + radius, y + radius):
+            position = parse_coordinate(scan_name)
+            if (position[0] - x) ** 2 + (position[1] - y) ** 2 <= radius ** 2:
+                matched_scans.append(scan_name)
+
+        return matched_scans
+
+    def query(self, scan_or_coord):
+        """
+        Resolves a Scan/Coordinate cell to the matching scan names.
+
+        Supported forms are an exact scan name, "rect(x1, y1, x2, y2)", "circle(x, y, r)",
+        a well range such as "A1:B12" and a single position such as "12,34" or "B7".
+        Exact scan names take precedence over the other forms.
+
+        Args:
+        scan_or_coord: str, value of the Scan/Coordinate cell
+
+        Returns:
+        scan_names: list, matching scan names in the order of the file
+        """
+        if scan_or_coord in self.scan_order:
+            return [scan_or_coord]
+
+        query_string = str(scan_or_coord)
+
+        rect_match = RECT_QUERY_PATTERN.match(query_string)
+        if rect_match:
+            return self.rectangle(*[float(value) for value in rect_match.groups()])
+
+        circle_match = CIRCLE_QUERY_PATTERN.match(query_string)
+        if circle_match:
+            return self.circle(*[float(value) for value in circle_match.groups()])
+
+        well_range_match = WELL_RANGE_QUERY_PATTERN.match(query_string)
+        if well_range_match:
+            start_position = parse_coordinate(well_range_match.group(1))
+            end_position = parse_coordinate(well_range_match.group(2))
+            return self.rectangle(start_position[0], start_position[1], end_position[0], end_position[1])
+
+        position = parse_coordinate(query_string)
+        if position is not None:
+            return self.rectangle(position[0], position[1], position[0], position[1])
+
+        return []
@@ -0,0 +1,324 @@
+import os
+import argparse
+import glob
+import json
+import hashlib
+import math
+import pandas as pd
+from pyteomics import mzml
+
+import task_profile
+from convert_metadata import load_metadata_file
+
+REPORT_COLUMNS = ["filename", "scan", "status", "duplicate_of_filename", "duplicate_of_scan", "duplicate_source", "similarity"]
+
+
+def compute_signature(mz_array, intensity_array, bin_size):
+    """
+    Turns a binned spectrum into a compact signature: the sorted bin indices and the
+    unit length sqrt scaled weights of those bins, plus a digest for exact matching.
+
+    Args:
+    mz_array: list, m/z values of the binned spectrum
+    intensity_array: list, intensities of the binned spectrum
+    bin_size: float, width of the m/z bins used by merge_spectra.py
+
+    Returns:
+    signature: dict, with bins, weights and digest keys
+    """
+    bin_weights = {}
+    for mz, intensity in zip(mz_array, intensity_array):
+        if not intensity > 0:
+            continue
+        bin_index = int(round(float(mz) / bin_size))
+        bin_weights[bin_index] = bin_weights.get(bin_index, 0.0) + float(intensity)
+
+    bins = sorted(bin_weights.keys())
+    # Square root scaling keeps a few dominant peaks from deciding the similarity alone
+    weights = [math.sqrt(bin_weights[bin_index]) for bin_index in bins]
+    norm = math.sqrt(sum(weight * weight for weight in weights))
+    if norm > 0:
+        weights = [weight / norm for weight in weights]
+
+    weights = [round(weight, 6) for weight in weights]
+
+    digest_source = ",".join("{}:{:.4f}".format(bin_index, weight) for bin_index, weight in zip(bins, weights))
+    digest = hashlib.sha1(digest_source.encode("utf-8")).hexdigest()
+
+    return {
+        "bins": bins,
+        "weights": weights,
+        "digest": digest
+    }
+
+
+class SignatureIndex:
+    """
+    Local similarity index over spectrum signatures.
+
+    Exact duplicates are found through the digest. Near duplicates are found through an
+    inverted index on the highest weighted bins of every signature, the candidates are
+    then scored with the sparse cosine over all of their bins.
+    """
+
+    def __init__(self, anchor_count=10):
+        self.anchor_count = anchor_count
+        self.entries = []
+        self.bin_vectors = []
+        self.digest_to_entry = {}
+        self.anchor_to_entries = {}
+
+    def _anchors(self, signature):
+        ranked = sorted(zip(signature["weights"], signature["bins"]), reverse=True)
+        return [bin_index for weight, bin_index in ranked[:self.anchor_count]]
+
+    def add(self, entry):
+        """
+        Adds an entry, a dict with filename, scan, source and signature keys.
+        """
+        entry_index = len(self.entries)
+        signature = entry["signature"]
+
+        self.entries.append(entry)
+        self.bin_vectors.append(dict(zip(signature["bins"], signature["weights"])))
+
+        if not signature["digest"] in self.digest_to_entry:
+            self.digest_to_entry[signature["digest"]] = entry_index
+
+        for bin_index in self._anchors(signature):
+            self.anchor_to_entries.setdefault(bin_index, []).append(entry_index)
+
+    def query(self, signature, similarity_threshold):
+        """
+        Finds the most similar entry already in the index.
+
+        Args:
+        signature: dict, output of compute_signature
+        similarity_threshold: float, minimum cosine to report a near duplicate
+
+        Returns:
+        match: tuple of (entry, similarity, match_type) or None, match_type is "exact" or "near"
+        """
+        if signature["digest"] in self.digest_to_entry:
+            return self.entries[self.digest_to_entry[signature["digest"]]], 1.0, "exact"
+
+        candidate_entries = set()
+        for bin_index in self._anchors(signature):
+            candidate_entries.update(self.anchor_to_entries.get(bin_index, []))
+
+        best_match = None
+        for entry_index in candidate_entries:
+            bin_vector = self.bin_vectors[entry_index]
+            similarity = sum(weight * bin_vector.get(bin_index, 0.0) for bin_index, weight in zip(signature["bins"], signature["weights"]))
+
+            if similarity >= similarity_threshold and (best_match is None or similarity > best_match[1]):
+                best_match = (self.entries[entry_index], similarity, "near")
+
+        return best_match
+
+
+def load_archive(archive_path):
+    """
+    Reads the locally cached signatures of past depositions.
+
+    Args:
+    archive_path: str, path to the archive JSON, may be empty or missing
+
+    Returns:
+    archive_entries: list, entries with filename, scan, source and signature keys
+    """
+    if not archive_path or not os.path.exists(archive_path):
+        return []
+
+    archive_entries = json.load(open(archive_path))
+    for entry in archive_entries:
+        entry["source"] = "archive"
+
+    return archive_entries
+
+
+def write_archive(archive_path, archive_entries):
+    """
+    Writes the signatures to the archive, replacing it atomically so that concurrent runs never read a partial archive.
+
+    Args:
+    archive_path: str, path to the archive JSON
+    archive_entries: list, entries with filename, scan and signature keys
+    """
+    archive_folder = os.path.dirname(archive_path)
+    if archive_folder and not os.path.exists(archive_folder):
+        os.makedirs(archive_folder, exist_ok=True)
+
+    temporary_path = "{}.{}.tmp".format(archive_path, os.getpid())
+    open(temporary_path, "w").write(json.dumps(archive_entries))
+    os.replace(temporary_path, archive_path)
+
+
+def commit_archive(archive_path, candidate_entries):
+    """
+    Adds the candidate signatures of a finished deposition to the archive.
+
+    The archive is read again rather than taken from the start of the run, so that signatures
+    committed by other runs in the meantime are kept. Candidates already in the archive are skipped.
+
+    Args:
+    archive_path: str, path to the archive JSON
+    candidate_entries: list, entries with filename, scan and signature keys
+
+    Returns:
+    added_count: int, number of signatures added
+    """
+    archive_entries = [{k: v for k, v in entry.items() if k != "source"} for entry in load_archive(archive_path)]
+    archived_digests = set(entry["signature"]["digest"] for entry in archive_entries)
+
+    new_entries = []
+    for entry in candidate_entries:
+        if entry["signature"]["digest"] in archived_digests:
+            continue
+        archived_digests.add(entry["signature"]["digest"])
+        new_entries.append(entry)
+
+    write_archive(archive_path, archive_entries + new_entries)
+
+    return len(new_entries)
+
+
+def find_metadata_duplicates(metadata_df):
+    """
+    Flags the metadata rows that reuse the Filename and Scan/Coordinate of an earlier row, e.g. one
+    mzML listed under several strains. The merged spectra hold one copy of every file so the
+    spectral comparison cannot see these.
+
+    Args:
+    metadata_df: pd.DataFrame, metadata with the Filename and Scan/Coordinate columns
+
+    Returns:
+    all_rows: list, report rows with the metadata_duplicate status, one for every repeated row
+    """
+    metadata_df = metadata_df.rename(columns=lambda column: str(column).strip())
+    if not "Filename" in metadata_df.columns or not "Scan/Coordinate" in metadata_df.columns:
+        return []
+
+    all_rows = []
+    first_rows = {}
+    for row_index, metadata_row in metadata_df.iterrows():
+        if pd.isna(metadata_row["Filename"]):
+            continue
+
+        pair = (str(metadata_row["Filename"]).strip(), str(metadata_row["Scan/Coordinate"]).strip())
+        strain_name = metadata_row.get("Strain name", "")
+
+        if not pair in first_rows:
+            first_rows[pair] = (row_index, strain_name)
+            continue
+
+        first_row_index, first_strain_name = first_rows[pair]
+        all_rows.append({
+            "filename": pair[0],
+            "scan": pair[1],
+            "status": "metadata_duplicate",
+            "duplicate_of_filename": pair[0],
+            "duplicate_of_scan": pair[1],
+            "duplicate_source": "metadata row {} ({}) reused by row {} ({})".format(first_row_index, first_strain_name, row_index, strain_name),
+            "similarity": ""
+        })
+        task_profile.count("metadata_duplicates")
+
+        print("Duplicate metadata row", row_index, strain_name, "reuses", pair[0], pair[1], "of row", first_row_index, first_strain_name)
+
+    return all_rows
+
+
+@task_profile.timed("parse")
+def load_signatures(input_filename, bin_size):
+    all_entries = []
+
+    with mzml.read(input_filename) as reader:
+        for spectrum in reader:
+            all_entries.append({
+                "filename": os.path.basename(input_filename),
+                "scan": spectrum["id"],
+                "source": "submission",
+                "signature": compute_signature(spectrum["m/z array"], spectrum["intensity array"], bin_size)
+            })
+
+    return all_entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flag exact and near duplicate spectra before deposition.')
+    parser.add_argument('input_folder', help='Folder of binned mzML files from merge_spectra.py')
+    parser.add_argument('output_report', help='Path to save the duplicate .tsv report')
+    parser.add_argument('--bin_size', default=10.0, type=float)
+    parser.add_argument('--similarity_threshold', default=0.98, type=float, help='Minimum cosine to flag a near duplicate')
+    parser.add_argument('--metadata', default=None, help='Metadata file, rows reusing a Filename and Scan/Coordinate are flagged as well')
+    parser.add_argument('--archive', default=None, help='Path to the local archive of previously deposited signatures, it is only read')
+    parser.add_argument('--output_candidates', default=None, help='Path to write the signatures of the new unique spectra, committed to the archive with commit_dedup_archive.py once they are deposited')
+    parser.add_argument('--profile_output', default=None, help='Path to write a JSON performance profile of this task')
+
+    args = parser.parse_args()
+
+    archive_entries = load_archive(args.archive)
+    print("Loaded {} archived signatures".format(len(archive_entries)))
+
+    index = SignatureIndex()
+    with task_profile.timer("indexing"):
+        for entry in archive_entries:
+            index.add(entry)
+
+    all_input_files = glob.glob(os.path.join(args.input_folder, "*.mzML"))
+    all_input_files.sort()
+
+    all_rows = []
+    new_entries = []
+
+    for input_filename in all_input_files:
+        for entry in load_signatures(input_filename, args.bin_size):
+            task_profile.count("scans")
+
+            with task_profile.timer("scoring"):
+                match = index.query(entry["signature"], args.similarity_threshold)
+
+            row = {
+                "filename": entry["filename"],
+                "scan": entry["scan"],
+                "status": "unique",
+                "duplicate_of_filename": "",
+                "duplicate_of_scan": "",
+                "duplicate_source": "",
+                "similarity": ""
+            }
+
+            if match is not None:
+                matched_entry, similarity, match_type = match
+                row["status"] = "{}_duplicate".format(match_type)
+                row["duplicate_of_filename"] = matched_entry["filename"]
+                row["duplicate_of_scan"] = matched_entry["scan"]
+                row["duplicate_source"] = matched_entry["source"]
+                row["similarity"] = round(similarity, 4)
+                task_profile.count("duplicates")
+
+                print("Duplicate spectrum", entry["filename"], entry["scan"], "of", matched_entry["filename"], matched_entry["scan"], row["similarity"])
+            else:
+                new_entries.append(entry)
+
+            # Adding it even if it is a duplicate so later spectra in the submission are checked against it
+            index.add(entry)
+            all_rows.append(row)
+
+    if args.metadata:
+        all_rows += find_metadata_duplicates(load_metadata_file(args.metadata))
+
+    report_df = pd.DataFrame(all_rows, columns=REPORT_COLUMNS)
+    report_df.to_csv(args.output_report, sep="\t", index=False)
+
+    # The archive is only extended after the deposition succeeded, otherwise a retry would find its own spectra there
+    if args.output_candidates:
+        candidate_entries = [{k: v for k, v in entry.items() if k != "source"} for entry in new_entries]
+        open(args.output_candidates, "w").write(json.dumps(candidate_entries))
+
+    task_profile.write_profile(args.profile_output, "dedup_spectra")
+
+
+if __name__ == "__main__":
+    main()
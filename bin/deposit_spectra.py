@@ -3,25 +3,37 @@ import argparse
 from pathlib import Path
 import glob
 import json
+import csv
+import queue
+import threading
 import requests
 import yaml
+import pandas as pd
 from dotenv import dotenv_values
 
+import task_profile
+import spectrum_encoding
+from existing_names import load_existing_names
+from convert_metadata import load_metadata_file
+
 #SERVER_URL = "http://169.235.26.140:5392/" # This is Debug Server
 SERVER_URL = "https://idbac.org/"
 
-def _validate_entry(spectrum_obj, existing_names):
+def _validate_entry(spectrum_obj, existing_names, require_spectrum=True):
     valid_fields = ["spectrum", "Strain name", "Strain ID", "Filename",
                     "Scan/Coordinate", "Genbank accession", "NCBI taxid", "16S Taxonomy",
                     "16S Sequence", "Culture Collection", "MALDI matrix name", "MALDI prep",
                     "Cultivation media", "Cultivation temp", "Cultivation time", "Isolation media", "PI",
                     "MS Collected by", "Isolate Collected by", "Sample Collected by",
                     "Sample name", "Isolate Source", "Source Location Name", "Longitude",
-                    "Latitude", "Altitude", "Collection Temperature", "MALDI instrument", "Comment", "License", "Data Source"]
+                    "Latitude", "Altitude", "Collection Temperature", "MALDI instrument", "Comment", "License", "Data Source",
+                    "Spectrum encoding"]
     
     required_fields = ["spectrum", "Strain name", "Filename", "MALDI matrix name", "MALDI prep",
                     "Cultivation media", "Cultivation temp", "Cultivation time", "PI"]
 
+    if not require_spectrum:
+        required_fields.remove("spectrum")
 
     new_spectrum_obj = {}
 
@@ -37,31 +49,270 @@ def _validate_entry(spectrum_obj, existing_names):
             print("Missing Required Field", key)
             raise Exception(f"Missing Required Field, {key}") from None
 
+    if new_spectrum_obj["Strain name"] in existing_names:
+        print("Strain name already exists in the knowledgebase", new_spectrum_obj["Strain name"])
+        task_profile.count("existing_strain_names")
+
     return new_spectrum_obj
 
 
+def _validate_metadata(metadata_path, existing_names):
+    """
+    Validates every metadata row that names a spectra file, before the extraction produces any record.
+
+    Pipelined uploads start with the first extracted spectrum, so an invalid row has to be found
+    before then, otherwise the rows ahead of it would already be deposited.
+
+    Args:
+    metadata_path: str, path to the metadata file
+    existing_names: ExistingNames, strain names already in the knowledgebase
+    """
+    metadata_df = load_metadata_file(metadata_path)
+    metadata_df.columns = metadata_df.columns.str.strip()
+
+    for metadata_row in metadata_df.to_dict('records'):
+        # Rows without a file are never extracted
+        if pd.isnull(metadata_row.get("Filename")):
+            continue
+
+        _validate_entry(metadata_row, existing_names, require_spectrum=False)
+
+
+def _load_duplicate_filenames(duplicate_report):
+    """
+    Reads the report of dedup_spectra.py.
+
+    Returns:
+    duplicate_filenames: set, filenames whose spectra are all duplicates
+    duplicate_pairs: set, (Filename, Scan/Coordinate) pairs used by more than one metadata row
+    checked_filenames: set, filenames whose spectra were compared, only the top level files of the spectra folder
+    """
+    filename_status = {}
+    duplicate_pairs = set()
+    with open(duplicate_report) as report_file:
+        for row in csv.DictReader(report_file, delimiter="\t"):
+            if row["status"] == "metadata_duplicate":
+                duplicate_pairs.add((row["filename"], row["scan"]))
+                continue
+
+            is_duplicate = row["status"] != "unique"
+            filename_status[row["filename"]] = filename_status.get(row["filename"], True) and is_duplicate
+
+    duplicate_filenames = set(filename for filename, is_duplicate in filename_status.items() if is_duplicate)
+
+    return duplicate_filenames, duplicate_pairs, set(filename_status.keys())
+
+
+def _skip_metadata_duplicates(all_records, duplicate_pairs):
+    """
+    Yields the records, dropping every record after the first that uses a duplicated Filename and Scan/Coordinate pair.
+    """
+    seen_pairs = set()
+    for spectrum_obj in all_records:
+        stripped_obj = {str(k).strip(): v for k, v in spectrum_obj.items()}
+        pair = (str(stripped_obj.get("Filename", "")).strip(), str(stripped_obj.get("Scan/Coordinate", "")).strip())
+        if pair in duplicate_pairs:
+            if pair in seen_pairs:
+                print("Skipping duplicate metadata row", pair[0], pair[1], stripped_obj.get("Strain name"))
+                task_profile.count("spectra_skipped_duplicate")
+                continue
+            seen_pairs.add(pair)
+
+        yield spectrum_obj
+
+
+def _warn_unchecked_filenames(all_records, checked_filenames):
+    """
+    Yields the records, warning once for every Filename whose spectra the duplicate detection did not compare,
+    e.g. files in a subdirectory of the spectra folder. Their duplicates cannot be skipped.
+    """
+    warned_filenames = set()
+    for spectrum_obj in all_records:
+        stripped_obj = {str(k).strip(): v for k, v in spectrum_obj.items()}
+        filename = str(stripped_obj.get("Filename", "")).strip()
+        if not filename in checked_filenames:
+            if not filename in warned_filenames:
+                print("Warning, the spectra of {} were not checked for duplicates, none of its rows are skipped as duplicates".format(filename))
+                warned_filenames.add(filename)
+            task_profile.count("spectra_not_checked_for_duplicates")
+
+        yield spectrum_obj
+
+
+def _read_stream(stream_path):
+    """
+    Yields the records of a JSON lines stream from processing_spectra.py --stream_output as they are written.
+
+    The stream can be a named pipe, it has to end with the end of stream marker so that a
+    truncated extraction is not mistaken for a complete one.
+    """
+    with open(stream_path) as stream_file:
+        for line in stream_file:
+            if len(line.strip()) == 0:
+                continue
+
+            record = json.loads(line)
+            if record.get(spectrum_encoding.END_OF_STREAM_KEY):
+                return
+
+            yield record
+
+    raise Exception(f"Stream {stream_path} ended without the end of stream marker, the extraction did not finish") from None
+
+
+def _deposit_spectrum(spectrum_obj, args, workflow_params, config, duplicate_filenames):
+    parameters = {}
+
+    if args.skip_duplicates == "Yes" and spectrum_obj["Filename"] in duplicate_filenames:
+        print("Skipping duplicate spectrum", spectrum_obj["Filename"], spectrum_obj.get("Strain name"))
+        task_profile.count("spectra_skipped_duplicate")
+        return
+
+    parameters["task"] = workflow_params["task"]
+    parameters["user"] = workflow_params["OMETAUSER"]
+    parameters["CREDENTIALSKEY"] = config["CREDENTIALSKEY"]
+    if args.spectrum_encoding == "json":
+        # Falling back to the plain form for servers that do not read the binary encoding
+        with task_profile.timer("decode"):
+            spectrum_encoding.decode_record(spectrum_obj)
+
+    with task_profile.timer("serialize"):
+        parameters["spectrum_json"] = json.dumps(spectrum_obj)
+    # Counting the UTF-8 bytes sent, not the characters
+    spectrum_json_bytes = len(parameters["spectrum_json"].encode("utf-8"))
+    task_profile.count("spectra")
+    task_profile.count("bytes_serialized", spectrum_json_bytes)
+
+    if args.dryrun == "No":
+        print("Submitting Spectrum")
+        with task_profile.timer("upload"):
+            r = requests.post("{}/api/spectrum".format(SERVER_URL), data=parameters)
+            r.raise_for_status()
+        task_profile.count("spectra_uploaded")
+        task_profile.count("bytes_uploaded", spectrum_json_bytes)
+
+
+def _deposit_pipelined(all_records, deposit_function, queue_size=16, upload_workers=2):
+    """
+    Uploads the records concurrently through a bounded queue as they are produced.
+
+    The records have to be validated beforehand, with _validate_entry or _validate_metadata, only the
+    spectrum field is checked here.
+
+    Args:
+    all_records: iterable, records, e.g. from _read_stream
+    deposit_function: function, uploads a single validated record
+    queue_size: int, maximum number of validated records waiting for upload
+    upload_workers: int, number of upload threads
+    """
+    record_queue = queue.Queue(maxsize=queue_size)
+    upload_errors = []
+
+    def _uploader():
+        while True:
+            spectrum_obj = record_queue.get()
+            if spectrum_obj is None:
+                return
+            # After an error the remaining records are only drained so the producer is not blocked
+            if len(upload_errors) > 0:
+                continue
+            try:
+                deposit_function(spectrum_obj)
+            except Exception as e:
+                upload_errors.append(e)
+
+    all_uploaders = [threading.Thread(target=_uploader, daemon=True) for i in range(upload_workers)]
+    for uploader in all_uploaders:
+        uploader.start()
+
+    try:
+        for spectrum_obj in all_records:
+            if len(upload_errors) > 0:
+                break
+
+            # Strip whitespace from the keys
+            spectrum_obj = {k.strip(): v for k, v in spectrum_obj.items()}
+
+            if not "spectrum" in spectrum_obj:
+                print("Missing spectrum field, skipping", spectrum_obj)
+                continue
+
+            with task_profile.timer("queue_wait"):
+                record_queue.put(spectrum_obj)
+    finally:
+        for uploader in all_uploaders:
+            record_queue.put(None)
+        for uploader in all_uploaders:
+            uploader.join()
+
+    if len(upload_errors) > 0:
+        raise upload_errors[0]
+
+
 def main():
     parser = argparse.ArgumentParser(description='Depositing the spectra one at a time.')
-    parser.add_argument('input_json_folder')
+    parser.add_argument('input_json_folder', nargs='?', default=None)
     parser.add_argument('--params')
     parser.add_argument('--dryrun', default="Yes")
     parser.add_argument('--existing_names', required=True)
+    parser.add_argument('--duplicate_report', default=None, help='Duplicate report from dedup_spectra.py')
+    parser.add_argument('--spectrum_encoding', default="json", help='json to upload plain [mz, i] lists, binary to upload the binary encoded spectra as is')
+    parser.add_argument('--skip_duplicates', default="No", help='Skip files whose spectra are all flagged as duplicates, and repeats of a metadata row')
+    parser.add_argument('--stream_input', default=None, help='JSON lines stream, e.g. a named pipe, from processing_spectra.py --stream_output')
+    parser.add_argument('--metadata', default=None, help='Metadata file the stream is extracted from, required with --stream_input so every row is validated before the first upload')
+    parser.add_argument('--pipeline', default="No", help='Yes to upload concurrently once every record is validated')
+    parser.add_argument('--queue_size', default=16, type=int, help='Maximum number of validated spectra waiting for upload in pipeline mode')
+    parser.add_argument('--upload_workers', default=2, type=int, help='Number of upload threads in pipeline mode')
+    parser.add_argument('--refresh_database', default="Yes", help='Ask the knowledgebase to refresh once everything is deposited')
+    parser.add_argument('--profile_output', default=None, help='Path to write a JSON performance profile of this task')
 
     args = parser.parse_args()
 
     existing_names_file = Path(str(args.existing_names))
 
-    existing_names = json.load(open(existing_names_file, 'r'))
+    existing_names = load_existing_names(existing_names_file)
 
     config = dotenv_values()
 
+    workflow_params = {}
+    if args.params is not None:
+        workflow_params = yaml.safe_load(open(args.params))
+
+    duplicate_filenames = set()
+    duplicate_pairs = set()
+    checked_filenames = None
+    if args.duplicate_report and os.path.exists(args.duplicate_report):
+        duplicate_filenames, duplicate_pairs, checked_filenames = _load_duplicate_filenames(args.duplicate_report)
+        for filename in sorted(duplicate_filenames):
+            print("Duplicate spectra found for", filename)
+        for filename, scan in sorted(duplicate_pairs):
+            print("Duplicate metadata rows found for", filename, scan)
+
+    if args.skip_duplicates != "Yes":
+        duplicate_pairs = set()
+        checked_filenames = None
+
+    def filter_duplicates(all_records):
+        all_records = _skip_metadata_duplicates(all_records, duplicate_pairs)
+        if checked_filenames is not None:
+            all_records = _warn_unchecked_filenames(all_records, checked_filenames)
+        return all_records
+
+    deposit_function = lambda spectrum_obj: _deposit_spectrum(spectrum_obj, args, workflow_params, config, duplicate_filenames)
+
     # Prepping the requests from the json
-    all_json_files = glob.glob(os.path.join(args.input_json_folder, "*.json"))
+    all_json_files = []
+    if args.input_json_folder is not None:
+        all_json_files = glob.glob(os.path.join(args.input_json_folder, "*.json"))
 
     for json_filename in all_json_files:
         print(json_filename)
 
-        spectra_list = json.load(open(json_filename))
+        with task_profile.timer("parse"):
+            spectra_list = json.load(open(json_filename))
+
+        spectra_list = list(filter_duplicates(spectra_list))
+
         # Strip whitespace from the keys
         spectra_list = [{k.strip(): v for k, v in d.items()} for d in spectra_list]
 
@@ -72,32 +323,38 @@ def main():
                 continue
     
             # Validate them ahead of time
-            _validate_entry(spectrum_obj, existing_names)
+            with task_profile.timer("validate"):
+                _validate_entry(spectrum_obj, existing_names)
             all_strain_names.append(spectrum_obj["Strain name"])
 
-        for spectrum_obj in spectra_list:
-            parameters = {}
-
-            workflow_params = yaml.safe_load(open(args.params))
+        if args.pipeline == "Yes":
+            _deposit_pipelined(spectra_list, deposit_function, queue_size=args.queue_size, upload_workers=args.upload_workers)
+            continue
 
+        for spectrum_obj in spectra_list:
             if not "spectrum" in spectrum_obj:
                 continue
 
-            parameters["task"] = workflow_params["task"]
-            parameters["user"] = workflow_params["OMETAUSER"]
-            parameters["CREDENTIALSKEY"] = config["CREDENTIALSKEY"]
-            parameters["spectrum_json"] = json.dumps(spectrum_obj)
+            deposit_function(spectrum_obj)
 
-            if args.dryrun == "No":
-                print("Submitting Spectrum")
-                r = requests.post("{}/api/spectrum".format(SERVER_URL), data=parameters)
-                r.raise_for_status()
+    if args.stream_input is not None:
+        if args.metadata is None:
+            raise ValueError("--metadata is required with --stream_input, the records are uploaded as they arrive")
+
+        # Records are only available one at a time, so their metadata is validated before the stream is opened
+        with task_profile.timer("validate"):
+            _validate_metadata(args.metadata, existing_names)
+
+        _deposit_pipelined(filter_duplicates(_read_stream(args.stream_input)), deposit_function, queue_size=args.queue_size, upload_workers=args.upload_workers)
 
     # Once we've updated everything, we should tell the KB to update
-    if args.dryrun == "No":
-        r = requests.get("{}/api/database/refresh".format(SERVER_URL))
-        r.raise_for_status()
+    if args.dryrun == "No" and args.refresh_database == "Yes":
+        with task_profile.timer("refresh"):
+            r = requests.get("{}/api/database/refresh".format(SERVER_URL))
+            r.raise_for_status()
+
+    task_profile.write_profile(args.profile_output, "deposit_spectra")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,169 @@
+import os
+import argparse
+import json
+import time
+import requests
+
+import task_profile
+
+
+def normalize_name(name):
+    """
+    Normalizes a strain name for duplicate checks, ignoring case and repeated whitespace.
+    """
+    return " ".join(str(name).split()).casefold()
+
+
+class ExistingNames:
+    """
+    Set of the strain names already in the knowledgebase, normalized for O(1) lookups.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.normalized_names = set(normalize_name(name) for name in self.names)
+
+    def __contains__(self, name):
+        return normalize_name(name) in self.normalized_names
+
+    def __len__(self):
+        return len(self.normalized_names)
+
+
+def load_existing_names(existing_names_path):
+    """
+    Reads the JSON list of names written by this script, or downloaded from the API.
+
+    Args:
+    existing_names_path: str, path to the JSON list
+
+    Returns:
+    existing_names: ExistingNames
+    """
+    return ExistingNames(json.load(open(existing_names_path, 'r')))
+
+
+def _read_cache(cache_path):
+    if not cache_path or not os.path.exists(cache_path):
+        return None
+
+    try:
+        return json.load(open(cache_path))
+    except Exception as e:
+        print("Could not read the existing names cache, ignoring it", cache_path, e)
+        return None
+
+
+def _write_cache(cache_path, cache):
+    if not cache_path:
+        return
+
+    cache_folder = os.path.dirname(cache_path)
+    if cache_folder and not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+
+    # Writing to a temporary file first so that concurrent runs never read a partial cache
+    temporary_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    open(temporary_path, "w").write(json.dumps(cache))
+    os.replace(temporary_path, cache_path)
+
+
+def fetch_existing_names(url, cache_path=None, ttl=3600, timeout=30, retries=3, backoff=2.0):
+    """
+    Gets the existing strain names, using the cached snapshot when it is fresh and refreshing it
+    with a conditional request otherwise. Falls back on the cached snapshot when the service is unreachable.
+
+    Args:
+    url: str, URL of the get_all_strain_names API
+    cache_path: str, path to the cached snapshot, None disables the cache
+    ttl: float, seconds a snapshot is used without asking the server
+    timeout: float, seconds before a request times out
+    retries: int, number of attempts
+    backoff: float, seconds to wait after the first failed attempt, doubled after every attempt
+
+    Returns:
+    names: list, the existing strain names
+
+    Raises:
+    requests.RequestException: if the service is unreachable and there is no cached snapshot
+    """
+    cache = _read_cache(cache_path)
+
+    # A snapshot of another server is never used, neither when fresh nor as a fallback
+    if cache is not None and cache.get("url") != url:
+        print("Existing names cache is for another URL, ignoring it", cache.get("url"))
+        cache = None
+
+    if cache is not None and time.time() - cache.get("fetched_at", 0) < ttl:
+        print("Using cached existing names from", cache_path)
+        return cache["names"]
+
+    headers = {}
+    if cache is not None:
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    last_error = None
+    for attempt in range(1, retries + 1):
+        try:
+            print("Attempt {} of {} to get the existing names".format(attempt, retries))
+            r = requests.get(url, headers=headers, timeout=timeout)
+
+            if r.status_code == 304 and cache is not None:
+                print("Existing names not modified, using cached snapshot")
+                cache["fetched_at"] = time.time()
+                _write_cache(cache_path, cache)
+                return cache["names"]
+
+            r.raise_for_status()
+            task_profile.count("bytes_downloaded", len(r.content))
+
+            names = r.json()
+            _write_cache(cache_path, {
+                "url": url,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+                "names": names
+            })
+            return names
+        except (requests.RequestException, ValueError) as e:
+            print("Getting the existing names failed:", e)
+            last_error = e
+            if attempt < retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    if cache is not None:
+        print("Service unreachable, falling back on the cached existing names from", cache_path)
+        return cache["names"]
+
+    raise requests.RequestException(f"Failed to get the existing names from {url} after {retries} attempts") from last_error
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Get the strain names already in the knowledgebase.')
+    parser.add_argument('idbac_url')
+    parser.add_argument('output_names')
+    parser.add_argument('--cache', default=None, help='Path to the cached snapshot of the existing names')
+    parser.add_argument('--ttl', default=3600, type=float, help='Seconds a cached snapshot is used without asking the server')
+    parser.add_argument('--timeout', default=30, type=float)
+    parser.add_argument('--retries', default=3, type=int)
+
+    args = parser.parse_args()
+
+    idbac_url = args.idbac_url.rstrip("/")
+    if not idbac_url.startswith("http://") and not idbac_url.startswith("https://"):
+        idbac_url = "https://" + idbac_url
+
+    with task_profile.timer("download"):
+        names = fetch_existing_names("{}/api/get_all_strain_names".format(idbac_url), cache_path=args.cache,
+                                     ttl=args.ttl, timeout=args.timeout, retries=args.retries)
+
+    print("Found {} existing names".format(len(names)))
+    open(args.output_names, "w").write(json.dumps(names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import re
+import mmap
+import zlib
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import unescape
+import numpy as np
+from pyteomics import mzml
+
+# A light scan over the raw bytes instead of a full XML parse, only the parts needed
+# for the peak arrays are located
+SPECTRUM_PATTERN = re.compile(rb'<spectrum\s([^>]*)>(.*?)</spectrum>', re.S)
+ATTRIBUTE_PATTERN = re.compile(rb'([\w:]+)="([^"]*)"')
+BINARY_DATA_ARRAY_PATTERN = re.compile(rb'<binaryDataArray\b[^>]*>(.*?)</binaryDataArray>', re.S)
+BINARY_PATTERN = re.compile(rb'<binary>(.*?)</binary>', re.S)
+
+MZ_ARRAY_ACCESSION = b'"MS:1000514"'
+INTENSITY_ARRAY_ACCESSION = b'"MS:1000515"'
+FLOAT32_ACCESSION = b'"MS:1000521"'
+FLOAT64_ACCESSION = b'"MS:1000523"'
+ZLIB_ACCESSION = b'"MS:1000574"'
+NO_COMPRESSION_ACCESSION = b'"MS:1000576"'
+PARAM_GROUP_REF = b'<referenceableParamGroupRef'
+
+
+class UnsupportedMzMLError(ValueError):
+    """Raised for mzML features this reader does not handle, callers should fall back on pyteomics."""
+
+
+def _parse_binary_data_array(array_xml):
+    # The cvParams of a param group are defined elsewhere in the file, so the array type cannot be told from here
+    if PARAM_GROUP_REF in array_xml:
+        raise UnsupportedMzMLError("Binary data array uses a referenceableParamGroupRef")
+
+    if MZ_ARRAY_ACCESSION in array_xml:
+        array_name = "m/z array"
+    elif INTENSITY_ARRAY_ACCESSION in array_xml:
+        array_name = "intensity array"
+    else:
+        raise UnsupportedMzMLError("Binary data array is neither an m/z nor an intensity array")
+
+    if FLOAT32_ACCESSION in array_xml:
+        dtype = "<f4"
+    elif FLOAT64_ACCESSION in array_xml:
+        dtype = "<f8"
+    else:
+        raise UnsupportedMzMLError("Unsupported binary data type for {}".format(array_name))
+
+    if ZLIB_ACCESSION in array_xml:
+        compressed = True
+    elif NO_COMPRESSION_ACCESSION in array_xml:
+        compressed = False
+    else:
+        raise UnsupportedMzMLError("Unsupported compression for {}".format(array_name))
+
+    binary_match = BINARY_PATTERN.search(array_xml)
+    encoded = binary_match.group(1).strip() if binary_match else b""
+
+    return array_name, (encoded, dtype, compressed)
+
+
+def _decode_binary(job):
+    encoded, dtype, compressed = job
+    if len(encoded) == 0:
+        return np.array([], dtype=dtype)
+
+    raw_bytes = base64.b64decode(encoded)
+    if compressed:
+        raw_bytes = zlib.decompress(raw_bytes)
+
+    # Native float arrays, the same as pyteomics returns
+    return np.frombuffer(raw_bytes, dtype=dtype).astype(np.dtype(dtype).newbyteorder("="))
+
+
+def _decode_batch(batch, executor):
+    # Only zlib releases the GIL, so only compressed arrays go to the thread pool, base64 and
+    # uncompressed arrays are decoded on the calling thread
+    compressed_jobs = [(spectrum, array_name, job) for spectrum, array_name, job in batch if job[2]]
+    if len(compressed_jobs) > 1:
+        all_arrays = executor.map(_decode_binary, [job for spectrum, array_name, job in compressed_jobs])
+        for (spectrum, array_name, job), array in zip(compressed_jobs, all_arrays):
+            spectrum[array_name] = array
+
+    for spectrum, array_name, job in batch:
+        if not array_name in spectrum:
+            spectrum[array_name] = _decode_binary(job)
+
+
+def _finish_spectrum(spectrum):
+    for array_name in ["m/z array", "intensity array"]:
+        if not array_name in spectrum:
+            spectrum[array_name] = np.array([], dtype="float64")
+
+    if len(spectrum["m/z array"]) != len(spectrum["intensity array"]):
+        raise UnsupportedMzMLError("Spectrum {} has m/z and intensity arrays of different lengths".format(spectrum["id"]))
+
+    return spectrum
+
+
+def iter_spectra(input_filename, max_workers=None, batch_size=64):
+    """
+    Yields the spectra of an mzML file, read through a memory map and decoded in batches so that
+    only batch_size spectra are held in memory at a time.
+
+    Args:
+    input_filename: str, path to the mzML file
+    max_workers: int, number of threads decompressing zlib arrays, defaults to the ThreadPoolExecutor default
+    batch_size: int, number of spectra decoded together
+
+    Yields:
+    spectrum: dict with the id, index, m/z array and intensity array keys as in pyteomics
+
+    Raises:
+    UnsupportedMzMLError: if the file uses an encoding that is not supported, e.g. numpress,
+        param groups or other array types. Spectra before the unsupported one may already have been yielded.
+    """
+    with open(input_filename, 'rb') as input_file, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            batch_spectra = []
+            batch = []
+            spectrum_count = 0
+
+            for spectrum_match in SPECTRUM_PATTERN.finditer(mapped_file):
+                attributes = dict(ATTRIBUTE_PATTERN.findall(spectrum_match.group(1)))
+
+                spectrum = {
+                    "id": unescape(attributes.get(b"id", b"").decode("utf-8"), {"&quot;": '"'}),
+                    "index": int(attributes.get(b"index", spectrum_count)),
+                }
+                spectrum_count += 1
+
+                for array_match in BINARY_DATA_ARRAY_PATTERN.finditer(spectrum_match.group(2)):
+                    array_name, job = _parse_binary_data_array(array_match.group(1))
+                    batch.append((spectrum, array_name, job))
+
+                batch_spectra.append(spectrum)
+
+                if len(batch_spectra) >= batch_size:
+                    _decode_batch(batch, executor)
+                    for spectrum in batch_spectra:
+                        yield _finish_spectrum(spectrum)
+                    batch_spectra = []
+                    batch = []
+
+            _decode_batch(batch, executor)
+            for spectrum in batch_spectra:
+                yield _finish_spectrum(spectrum)
+
+
+def read_spectra(input_filename, max_workers=None):
+    """
+    Reads all spectra of an mzML file with iter_spectra.
+
+    Returns:
+    all_spectra: list, dicts with the id, index, m/z array and intensity array keys as in pyteomics
+
+    Raises:
+    UnsupportedMzMLError: if the file uses an encoding that is not supported
+    """
+    return list(iter_spectra(input_filename, max_workers=max_workers))
+
+
+def load_spectra(input_filename, max_workers=None, batch_size=64):
+    """
+    Yields the spectra with iter_spectra, falling back on pyteomics for unsupported files.
+
+    When an unsupported spectrum is found part way through the file, pyteomics picks up after
+    the spectra that were already yielded.
+
+    Args:
+    input_filename: str, path to the mzML file
+    max_workers: int, number of decompression threads
+    batch_size: int, number of spectra decoded together
+
+    Yields:
+    spectrum: dict with at least the id, index, m/z array and intensity array keys
+    """
+    yielded_count = 0
+    try:
+        for spectrum in iter_spectra(input_filename, max_workers=max_workers, batch_size=batch_size):
+            yield spectrum
+            yielded_count += 1
+        return
+    except UnsupportedMzMLError as e:
+        print("Fast mzML reader not supported for {}, falling back on pyteomics: {}".format(input_filename, e))
+
+    with mzml.read(str(input_filename)) as reader:
+        for spectrum_index, spectrum in enumerate(reader):
+            if spectrum_index >= yielded_count:
+                yield spectrum
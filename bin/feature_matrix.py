@@ -0,0 +1,96 @@
+import zipfile
+import numpy as np
+
+
+def write_feature_matrix(output_filename, row_filenames, row_scans, row_spectrum_ids, all_row_bins, all_row_values, bin_size):
+    """
+    Writes the binned spectra as one sparse scan by bin matrix in CSR layout.
+
+    The NPZ is uncompressed and uses the same data, indices, indptr, shape and format keys as
+    scipy.sparse.save_npz, so scipy.sparse.load_npz can read it as well as load_feature_matrix.
+
+    Args:
+    output_filename: str, path to the output .npz file
+    row_filenames: list, input filename of every row
+    row_scans: list, scan of every row, "merged" when the replicates were merged
+    row_spectrum_ids: list, id of the spectrum of every row in the merged mzML
+    all_row_bins: list, array of the bin indices of every row
+    all_row_values: list, array of the intensities of every row, aligned with all_row_bins
+    bin_size: float, width of the m/z bins
+    """
+    all_bins = np.unique(np.concatenate(all_row_bins)) if len(all_row_bins) > 0 else np.array([], dtype=np.int64)
+
+    indptr = np.zeros(len(all_row_bins) + 1, dtype=np.int64)
+    all_indices = []
+    all_data = []
+    for row_index, (row_bins, row_values) in enumerate(zip(all_row_bins, all_row_values)):
+        order = np.argsort(row_bins)
+        all_indices.append(np.searchsorted(all_bins, row_bins[order]))
+        all_data.append(row_values[order])
+        indptr[row_index + 1] = indptr[row_index] + len(row_bins)
+
+    indices = np.concatenate(all_indices).astype(np.int32) if len(all_indices) > 0 else np.array([], dtype=np.int32)
+    data = np.concatenate(all_data).astype(np.float64) if len(all_data) > 0 else np.array([], dtype=np.float64)
+
+    np.savez(output_filename,
+             data=data,
+             indices=indices,
+             indptr=indptr,
+             shape=np.array([len(all_row_bins), len(all_bins)], dtype=np.int64),
+             format=np.array("csr"),
+             row_filename=np.array(row_filenames, dtype=str),
+             row_scan=np.array([str(scan) for scan in row_scans], dtype=str),
+             row_spectrum_id=np.array(row_spectrum_ids, dtype=str),
+             column_bin=all_bins.astype(np.int64),
+             column_mz=all_bins.astype(np.float64) * bin_size)
+
+
+def _memmap_member(npz_file, zip_info, input_filename):
+    # Skipping the local zip header to get to the .npy payload, only valid for stored members
+    npz_file.fp.seek(zip_info.header_offset)
+    local_header = npz_file.fp.read(30)
+    filename_length = int.from_bytes(local_header[26:28], "little")
+    extra_length = int.from_bytes(local_header[28:30], "little")
+    npz_file.fp.seek(zip_info.header_offset + 30 + filename_length + extra_length)
+
+    version = np.lib.format.read_magic(npz_file.fp)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file.fp)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file.fp)
+
+    if len(shape) == 0 or np.prod(shape) == 0:
+        return None
+
+    return np.memmap(input_filename, dtype=dtype, mode="r", offset=npz_file.fp.tell(), shape=shape,
+                     order="F" if fortran_order else "C")
+
+
+def load_feature_matrix(input_filename, mmap=True):
+    """
+    Reads a matrix written by write_feature_matrix.
+
+    Args:
+    input_filename: str, path to the .npz file
+    mmap: bool, memory-map the CSR arrays instead of reading them
+
+    Returns:
+    feature_matrix: dict, the CSR arrays, shape and the row and column labels
+    """
+    feature_matrix = {}
+
+    with zipfile.ZipFile(input_filename) as npz_file, np.load(input_filename) as loaded:
+        for key in loaded.files:
+            mapped_array = None
+            if mmap and key in ["data", "indices", "indptr"]:
+                zip_info = npz_file.getinfo(key + ".npy")
+                if zip_info.compress_type == zipfile.ZIP_STORED:
+                    mapped_array = _memmap_member(npz_file, zip_info, input_filename)
+
+            # Only the requested members are read, np.load is lazy for NPZ files
+            feature_matrix[key] = mapped_array if mapped_array is not None else loaded[key]
+
+    feature_matrix["shape"] = tuple(int(value) for value in feature_matrix["shape"])
+    feature_matrix["format"] = str(feature_matrix["format"])
+
+    return feature_matrix
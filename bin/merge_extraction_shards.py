@@ -0,0 +1,47 @@
+import os
+import argparse
+import glob
+import uuid
+import json
+import pandas as pd
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the per-shard extraction outputs back into a single JSON and TSV.')
+    parser.add_argument('input_folder', help='Folder with the JSON outputs of processing_spectra.py --shard')
+    parser.add_argument('output_folder')
+    parser.add_argument('--output_identifier', default=str(uuid.uuid4()))
+
+    args = parser.parse_args()
+
+    all_shard_files = glob.glob(os.path.join(args.input_folder, "*.json"))
+    all_shard_files.sort()
+
+    all_rows = []
+    for shard_filename in all_shard_files:
+        all_rows += json.load(open(shard_filename))
+
+    # Restoring the order of the original metadata sheet
+    all_rows.sort(key=lambda record: record["_metadata_row"])
+    for record in all_rows:
+        record.pop("_metadata_row")
+
+    print("Merged {} rows from {} shards".format(len(all_rows), len(all_shard_files)))
+
+    # Outputting the JSON
+    output_json = os.path.join(args.output_folder, args.output_identifier + ".json")
+    open(output_json, "w").write(json.dumps(all_rows, indent=4))
+
+    # Outputting the Summary
+    summary_df = pd.DataFrame(all_rows)
+    try:
+        summary_df = summary_df.drop(['spectrum'], axis=1)
+    except:
+        pass
+
+    output_extraction_tsv = os.path.join(args.output_folder, args.output_identifier + ".tsv")
+    summary_df.to_csv(output_extraction_tsv, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+import argparse
+import glob
+import json
+import pandas as pd
+
+
+def get_stage_rows(all_profiles):
+    """
+    Flattens the profiles into one row per task and stage.
+
+    Args:
+    all_profiles: list, profiles written by task_profile.write_profile
+
+    Returns:
+    summary_df: pd.DataFrame, task, hostname, stage, seconds, calls, wall_seconds and peak_rss_mb columns
+    """
+    # One row per task and stage so it is easy to sort and filter
+    all_rows = []
+    for profile in all_profiles:
+        for stage, stage_obj in profile.get("stages", {}).items():
+            all_rows.append({
+                "task": profile["task"],
+                "hostname": profile.get("hostname", ""),
+                "stage": stage,
+                "seconds": stage_obj["seconds"],
+                "calls": stage_obj["calls"],
+                "wall_seconds": profile.get("wall_seconds"),
+                "peak_rss_mb": profile.get("peak_rss_mb"),
+            })
+
+    return pd.DataFrame(all_rows, columns=["task", "hostname", "stage", "seconds", "calls", "wall_seconds", "peak_rss_mb"])
+
+
+def aggregate_profiles(all_profiles):
+    """
+    Sums the stages and counters of the profiles of every task and keeps the worst wall time and memory.
+
+    Args:
+    all_profiles: list, profiles written by task_profile.write_profile
+
+    Returns:
+    run_report: dict, profile_count, total_task_seconds and the per task summaries
+    """
+    # Aggregating across tasks of the same kind
+    tasks_summary = {}
+    for profile in all_profiles:
+        task = profile["task"]
+        if not task in tasks_summary:
+            tasks_summary[task] = {
+                "task_count": 0,
+                "wall_seconds": 0.0,
+                "max_wall_seconds": 0.0,
+                "max_peak_rss_mb": 0.0,
+                "stages": {},
+                "counters": {}
+            }
+        task_summary = tasks_summary[task]
+
+        task_summary["task_count"] += 1
+        task_summary["wall_seconds"] += profile.get("wall_seconds", 0.0)
+        task_summary["max_wall_seconds"] = max(task_summary["max_wall_seconds"], profile.get("wall_seconds", 0.0))
+        if profile.get("peak_rss_mb") is not None:
+            task_summary["max_peak_rss_mb"] = max(task_summary["max_peak_rss_mb"], profile["peak_rss_mb"])
+
+        for stage, stage_obj in profile.get("stages", {}).items():
+            if not stage in task_summary["stages"]:
+                task_summary["stages"][stage] = {"seconds": 0.0, "calls": 0}
+            task_summary["stages"][stage]["seconds"] += stage_obj["seconds"]
+            task_summary["stages"][stage]["calls"] += stage_obj["calls"]
+
+        for counter, value in profile.get("counters", {}).items():
+            task_summary["counters"][counter] = task_summary["counters"].get(counter, 0) + value
+
+    return {
+        "profile_count": len(all_profiles),
+        "total_task_seconds": round(sum(task["wall_seconds"] for task in tasks_summary.values()), 4),
+        "tasks": tasks_summary
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the per-task performance profiles into a run report.')
+    parser.add_argument('input_folder')
+    parser.add_argument('output_json')
+    parser.add_argument('output_tsv')
+
+    args = parser.parse_args()
+
+    all_profile_files = glob.glob(os.path.join(args.input_folder, "*.json"))
+    all_profile_files.sort()
+
+    all_profiles = []
+    for profile_filename in all_profile_files:
+        try:
+            all_profiles.append(json.load(open(profile_filename)))
+        except Exception as e:
+            print("Could not read profile, skipping", profile_filename, e)
+
+    summary_df = get_stage_rows(all_profiles)
+    summary_df.to_csv(args.output_tsv, sep="\t", index=False)
+
+    run_report = aggregate_profiles(all_profiles)
+
+    open(args.output_json, "w").write(json.dumps(run_report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
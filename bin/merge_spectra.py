@@ -7,8 +7,13 @@ from pyteomics import mzxml, mzml
 from psims.mzml.writer import MzMLWriter
 from tqdm import tqdm
 import glob
+import task_profile
+import fast_mzml
+import numpy as np
+from feature_matrix import write_feature_matrix
 
 
+@task_profile.timed("parse")
 def load_data(input_filename):
     try:
         ms1_df, ms2_df = msql_fileloading.load_data(input_filename)
@@ -42,29 +47,25 @@ def load_data(input_filename):
     all_i = []
     all_scan = []
     
-    # TODO: read the mzML directly
-    with mzml.read(input_filename) as reader:
-        for spectrum in tqdm(reader):
-            try:
-                scan = spectrum["id"].replace("scanId=", "").split("scan=")[-1]+f"_{spectrum['index']}"
-            except:
-                scan = spectrum["id"] + str(spectrum['index'])
-
-            # try:
-            #     scan = int(scan)
-            # except:
-            #     print("Scan numbers could not be converted to integers", file=sys.stderr)
-            #     sys.exit(1)
-
-            mz = spectrum["m/z array"]
-            intensity = spectrum["intensity array"]
-
-            all_mz += list(mz)
-            all_i += list(intensity)
-            all_scan += len(mz) * [scan]
-
-            print(spectrum["id"])
-            
+    for spectrum in tqdm(fast_mzml.load_spectra(input_filename)):
+        try:
+            scan = spectrum["id"].replace("scanId=", "").split("scan=")[-1]+f"_{spectrum['index']}"
+        except:
+            scan = spectrum["id"] + str(spectrum['index'])
+
+        # try:
+        #     scan = int(scan)
+        # except:
+        #     print("Scan numbers could not be converted to integers", file=sys.stderr)
+        #     sys.exit(1)
+
+        mz = spectrum["m/z array"]
+        intensity = spectrum["intensity array"]
+
+        all_mz += list(mz)
+        all_i += list(intensity)
+        all_scan += len(mz) * [scan]
+
     if len(all_mz) > 0:
         ms1_df['i'] = all_i
         ms1_df['mz'] = all_mz
@@ -73,6 +74,128 @@ def load_data(input_filename):
     return ms1_df, ms2_df
 
 
+def bin_spectra(ms1_df, bin_size, min_mz, max_mz, merge_replicates, filename):
+    """
+    Bins the peaks of every scan by m/z and optionally merges the replicate scans.
+
+    Args:
+    ms1_df: pd.DataFrame, peaks with i, mz and scan columns
+    bin_size: float, width of the m/z bins
+    min_mz: float, minimum m/z value to consider
+    max_mz: float, maximum m/z value to consider
+    merge_replicates: str, "Yes" to average the scans into a single spectrum
+    filename: str, name of the input file
+
+    Returns:
+    spectra_binned_df: pd.DataFrame, one row per scan with one BIN_ column per bin
+    """
+    # Filtering m/z
+    ms1_df = ms1_df[(ms1_df['mz'] >= min_mz) & (ms1_df['mz'] <= max_mz)]
+
+    # Bin the MS1 Data by m/z within each spectrum
+    ms1_df['bin'] = (ms1_df['mz'] / bin_size).astype(int)
+
+    # Now we need to group by scan and bin
+    ms1_df = ms1_df.groupby(['scan', 'bin']).agg({'i': 'sum'}).reset_index()
+    ms1_df["mz"] = ms1_df["bin"] * bin_size
+    ms1_df["bin_name"] = "BIN_" + ms1_df["bin"].astype(str)
+    
+    # Turning each scan into a 1d vector that is the intensity value for each bin
+    spectra_binned_df = ms1_df.pivot(index='scan', columns='bin_name', values='i').reset_index()
+    spectra_binned_df["filename"] = filename
+
+    bins_to_remove = []
+    # merging replicates
+    if merge_replicates == "Yes":
+        # Lets do the merge
+        all_bins = [x for x in spectra_binned_df.columns if x.startswith("BIN_")]
+        for bin in all_bins:
+            all_values = spectra_binned_df[bin]
+
+            # Count non-zero values
+            non_zero_count = len(all_values[all_values > 0])
+
+            # Calculate percent non-zero
+            percent_non_zero = non_zero_count / len(all_values)
+
+            if percent_non_zero < 0.5:
+                bins_to_remove.append(bin)
+
+        # Removing the bins
+        spectra_binned_df = spectra_binned_df.drop(bins_to_remove, axis=1)
+
+        # Now lets get the mean for each bin
+        spectra_binned_df.drop("scan", axis=1, inplace=True)    # Drop the can number in case it isn't numeric
+        spectra_binned_df = spectra_binned_df.groupby("filename").mean().reset_index()
+        spectra_binned_df["scan"] = "merged"
+
+    return spectra_binned_df
+
+
+def get_sparse_rows(spectra_binned_df):
+    """
+    Gets the non-zero bins of every binned spectrum, in the same order as write_merged_mzml writes them.
+
+    Args:
+    spectra_binned_df: pd.DataFrame, output of bin_spectra
+
+    Returns:
+    all_row_bins: list, array of the bin indices of every spectrum
+    all_row_values: list, array of the intensities of every spectrum
+    """
+    all_bins = [x for x in spectra_binned_df.columns if x.startswith("BIN_")]
+    bin_indices = np.array([int(x.replace("BIN_", "")) for x in all_bins], dtype=np.int64)
+    intensity_matrix = spectra_binned_df[all_bins].to_numpy(dtype=np.float64, na_value=0.0)
+
+    all_row_bins = []
+    all_row_values = []
+    for intensity_row in intensity_matrix:
+        non_zero = intensity_row > 0
+        all_row_bins.append(bin_indices[non_zero])
+        all_row_values.append(intensity_row[non_zero])
+
+    return all_row_bins, all_row_values
+
+
+def write_merged_mzml(output_filename, spectra_binned_df, bin_size):
+    """
+    Writes the binned spectra to an mzML file, one spectrum per row.
+
+    Args:
+    output_filename: str, path to the output mzML file
+    spectra_binned_df: pd.DataFrame, output of bin_spectra
+    bin_size: float, width of the m/z bins
+    """
+    with MzMLWriter(open(output_filename, 'wb'), close=True) as out:
+        # Add default controlled vocabularies
+        out.controlled_vocabularies()
+        # Open the run and spectrum list sections
+        with out.run(id="my_analysis"):
+            spectrum_count = len(spectra_binned_df)
+
+            spectrum_list = spectra_binned_df.to_dict(orient="records")
+
+            with out.spectrum_list(count=spectrum_count):
+                scan = 1
+                for spectrum_dict in spectrum_list:
+
+                    all_keys = list(spectrum_dict.keys())
+
+                    mz_array = [float(key.replace("BIN_", "")) * bin_size for key in all_keys if key.startswith("BIN_") if spectrum_dict[key] > 0]
+                    intensity_array = [spectrum_dict[key] for key in all_keys if key.startswith("BIN_") if spectrum_dict[key] > 0]
+
+                    # Write scan
+                    out.write_spectrum(
+                        mz_array, intensity_array,
+                        id="scan={}".format(scan), params=[
+                            "MS1 Spectrum",
+                            {"ms level": 1},
+                            {"total ion current": sum(intensity_array)}
+                        ])
+                    
+                    scan += 1
+
+
 def main():
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('input_folder')
@@ -81,6 +204,8 @@ def main():
     parser.add_argument('--bin_size', default=10.0, type=float)
     parser.add_argument('--min_mz', type=str, default='0.0', help='Minimum m/z value to consider')
     parser.add_argument('--max_mz', type=str, default='inf', help='Maximum m/z value to consider')
+    parser.add_argument('--feature_matrix', default=None, help='Path to write all binned spectra as one sparse scan by bin matrix (.npz)')
+    parser.add_argument('--profile_output', default=None, help='Path to write a JSON performance profile of this task')
 
     args = parser.parse_args()
 
@@ -108,81 +233,46 @@ def main():
 
     all_spectra_df_list = []
 
+    # Rows of the combined feature matrix
+    row_filenames = []
+    row_scans = []
+    row_spectrum_ids = []
+    all_row_bins = []
+    all_row_values = []
+
     for input_filename in all_input_files:
         print("Loading data from {}".format(input_filename))
         ms1_df, ms2_df = load_data(input_filename)
 
-        # Filtering m/z
-        ms1_df = ms1_df[(ms1_df['mz'] >= min_mz) & (ms1_df['mz'] <= max_mz)]
-
-        # Bin the MS1 Data by m/z within each spectrum
-        ms1_df['bin'] = (ms1_df['mz'] / bin_size).astype(int)
-
-        # Now we need to group by scan and bin
-        ms1_df = ms1_df.groupby(['scan', 'bin']).agg({'i': 'sum'}).reset_index()
-        ms1_df["mz"] = ms1_df["bin"] * bin_size
-        ms1_df["bin_name"] = "BIN_" + ms1_df["bin"].astype(str)
-        
-        # Turning each scan into a 1d vector that is the intensity value for each bin
-        spectra_binned_df = ms1_df.pivot(index='scan', columns='bin_name', values='i').reset_index()
-        spectra_binned_df["filename"] = os.path.basename(input_filename)
-
-        bins_to_remove = []
-        # merging replicates
-        if args.merge_replicates == "Yes":
-            # Lets do the merge
-            all_bins = [x for x in spectra_binned_df.columns if x.startswith("BIN_")]
-            for bin in all_bins:
-                all_values = spectra_binned_df[bin]
-
-                # Count non-zero values
-                non_zero_count = len(all_values[all_values > 0])
+        task_profile.count("input_files")
+        task_profile.count("peaks", len(ms1_df))
+        if len(ms1_df) > 0:
+            task_profile.count("scans", ms1_df["scan"].nunique())
 
-                # Calculate percent non-zero
-                percent_non_zero = non_zero_count / len(all_values)
-
-                if percent_non_zero < 0.5:
-                    bins_to_remove.append(bin)
-
-            # Removing the bins
-            spectra_binned_df = spectra_binned_df.drop(bins_to_remove, axis=1)
-
-            # Now lets get the mean for each bin
-            spectra_binned_df.drop("scan", axis=1, inplace=True)    # Drop the can number in case it isn't numeric
-            spectra_binned_df = spectra_binned_df.groupby("filename").mean().reset_index()
-            spectra_binned_df["scan"] = "merged"
+        with task_profile.timer("binning"):
+            spectra_binned_df = bin_spectra(ms1_df, bin_size, min_mz, max_mz, args.merge_replicates, os.path.basename(input_filename))
 
         # Writing an mzML file with the merged spectra
         output_filename = os.path.join(args.output_folder, os.path.basename(input_filename))
-        with MzMLWriter(open(output_filename, 'wb'), close=True) as out:
-            # Add default controlled vocabularies
-            out.controlled_vocabularies()
-            # Open the run and spectrum list sections
-            with out.run(id="my_analysis"):
-                spectrum_count = len(spectra_binned_df)
-
-                spectrum_list = spectra_binned_df.to_dict(orient="records")
-
-                with out.spectrum_list(count=spectrum_count):
-                    scan = 1
-                    for spectrum_dict in spectrum_list:
+        with task_profile.timer("serialize"):
+            write_merged_mzml(output_filename, spectra_binned_df, bin_size)
+        task_profile.count("bytes_written", os.path.getsize(output_filename))
 
-                        all_keys = list(spectrum_dict.keys())
+        if args.feature_matrix is not None:
+            row_bins, row_values = get_sparse_rows(spectra_binned_df)
+            all_row_bins += row_bins
+            all_row_values += row_values
+            row_filenames += [os.path.basename(input_filename)] * len(row_bins)
+            row_scans += list(spectra_binned_df["scan"])
+            row_spectrum_ids += ["scan={}".format(scan) for scan in range(1, len(row_bins) + 1)]
 
-                        mz_array = [float(key.replace("BIN_", "")) * bin_size for key in all_keys if key.startswith("BIN_") if spectrum_dict[key] > 0]
-                        intensity_array = [spectrum_dict[key] for key in all_keys if key.startswith("BIN_") if spectrum_dict[key] > 0]
+    if args.feature_matrix is not None:
+        with task_profile.timer("serialize"):
+            write_feature_matrix(args.feature_matrix, row_filenames, row_scans, row_spectrum_ids, all_row_bins, all_row_values, bin_size)
+        task_profile.count("bytes_written", os.path.getsize(args.feature_matrix))
 
-                        # Write scan
-                        out.write_spectrum(
-                            mz_array, intensity_array,
-                            id="scan={}".format(scan), params=[
-                                "MS1 Spectrum",
-                                {"ms level": 1},
-                                {"total ion current": sum(intensity_array)}
-                            ])
-                        
-                        scan += 1
+    task_profile.write_profile(args.profile_output, "merge_spectra")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,49 @@
+import pandas as pd
+
+
+def reduce_peaks(peaks_list, snr=4.0, half_window=20, min_intensity=0.0, top_n=0, baseline_half_window=100):
+    """
+    Reduces a profile spectrum to its peaks, similar to the sqrt transform, baseline removal and MAD peak detection of baselineCorrection.R.
+
+    Peaks are detected on the square root of the intensities, which evens out the counting noise along
+    the spectrum. The baseline is the rolling median over baseline_half_window points on either side and
+    the noise is the median absolute deviation from it over the same window, so that both follow the
+    baseline along the spectrum. A point is kept if its baseline corrected intensity is the local maximum
+    within half_window points on either side and is above snr times the noise.
+
+    The kept peaks have the raw intensity measured at their apex, not a baseline corrected one.
+
+    Args:
+    peaks_list: list, [mz, i] pairs sorted by m/z
+    snr: float, signal to noise ratio a peak must exceed
+    half_window: int, number of points on either side a peak must be the maximum of
+    min_intensity: float, floor on the raw apex intensity, peaks below it are dropped
+    top_n: int, keep only the peaks highest above the baseline, 0 keeps all of them
+    baseline_half_window: int, number of points on either side used for the baseline and the noise
+
+    Returns:
+    reduced_peaks_list: list, [mz, i] pairs sorted by m/z
+    """
+    if len(peaks_list) == 0:
+        return peaks_list
+
+    peaks_df = pd.DataFrame(peaks_list, columns=["mz", "i"])
+
+    baseline_window = 2 * baseline_half_window + 1
+    sqrt_intensity = peaks_df["i"].clip(lower=0) ** 0.5
+    baseline = sqrt_intensity.rolling(baseline_window, center=True, min_periods=1).median()
+    corrected_intensity = sqrt_intensity - baseline
+
+    # Local MAD noise estimate, scaled to be consistent with the standard deviation
+    noise = corrected_intensity.abs().rolling(baseline_window, center=True, min_periods=1).median() * 1.4826
+
+    local_max = corrected_intensity.rolling(2 * half_window + 1, center=True, min_periods=1).max()
+
+    peaks_df["height"] = peaks_df["i"] - baseline ** 2
+    peaks_df = peaks_df[(corrected_intensity == local_max) & (corrected_intensity > snr * noise) & (peaks_df["i"] >= min_intensity)]
+
+    # Ranking by the height above the baseline, so peaks on a high baseline are not favored
+    if top_n > 0 and len(peaks_df) > top_n:
+        peaks_df = peaks_df.nlargest(top_n, "height").sort_values("mz")
+
+    return peaks_df[["mz", "i"]].values.tolist()
@@ -4,10 +4,17 @@ import argparse
 import pandas as pd
 import uuid
 import json
+import signal
 from massql import msql_fileloading
 from pyteomics import mzxml, mzml
 from tqdm import tqdm
+import task_profile
+import fast_mzml
+import spectrum_encoding
+from coordinate_index import CoordinateIndex
+from peak_reduction import reduce_peaks
 
+@task_profile.timed("parse")
 def load_data(input_filename):
     try:
         ms1_df, ms2_df = msql_fileloading.load_data(input_filename)
@@ -33,23 +40,19 @@ def load_data(input_filename):
     all_i = []
     all_scan = []
     
-    # TODO: read the mzML directly
-    with mzml.read(input_filename) as reader:
-        for spectrum in tqdm(reader):
-            try:
-                scan = spectrum["id"].replace("scanId=", "").split("scan=")[-1]+f"_{spectrum['index']}"
-            except:
-                scan = spectrum["id"] + str(spectrum['index'])
-
-            mz = spectrum["m/z array"]
-            intensity = spectrum["intensity array"]
-
-            all_mz += list(mz)
-            all_i += list(intensity)
-            all_scan += len(mz) * [scan]
-
-            print(spectrum["id"])
-            
+    for spectrum in tqdm(fast_mzml.load_spectra(input_filename)):
+        try:
+            scan = spectrum["id"].replace("scanId=", "").split("scan=")[-1]+f"_{spectrum['index']}"
+        except:
+            scan = spectrum["id"] + str(spectrum['index'])
+
+        mz = spectrum["m/z array"]
+        intensity = spectrum["intensity array"]
+
+        all_mz += list(mz)
+        all_i += list(intensity)
+        all_scan += len(mz) * [scan]
+
     if len(all_mz) > 0:
         ms1_df['i'] = all_i
         ms1_df['mz'] = all_mz
@@ -57,6 +60,14 @@ def load_data(input_filename):
 
     return ms1_df, ms2_df
 
+def get_peaks_list(scan_df, min_mz, max_mz):
+    peaks_list = scan_df.to_dict('records')
+    peaks_list = [[peak["mz"], peak["i"]] for peak in peaks_list]
+    # Filtering by m/z range
+    peaks_list = [peak for peak in peaks_list if min_mz <= peak[0] <= max_mz]
+
+    return peaks_list
+
 def load_metadata_file(metadata_path:str):
     """
     Reads a metadata file and converts it to a pandas dataframe. 
@@ -127,6 +138,19 @@ def main():
     parser.add_argument('--output_identifier', default=str(uuid.uuid4()))
     parser.add_argument('--min_mz', type=str, default='0.0', help='Minimum m/z value to consider')
     parser.add_argument('--max_mz', type=str, default='inf', help='Maximum m/z value to consider')
+    parser.add_argument('--profile_output', default=None, help='Path to write a JSON performance profile of this task')
+    parser.add_argument('--reduce_peaks', default="No", help='Yes to deposit the detected peaks, with their raw apex intensity, instead of every profile point')
+    parser.add_argument('--peak_snr', default=4.0, type=float, help='Signal to noise ratio for peak detection when reducing peaks')
+    parser.add_argument('--peak_half_window', default=20, type=int, help='Half window size in points for peak detection when reducing peaks')
+    parser.add_argument('--baseline_half_window', default=100, type=int, help='Half window size in points for the baseline removed before peak detection')
+    parser.add_argument('--min_peak_intensity', default=0.0, type=float, help='Raw apex intensity floor when reducing peaks')
+    parser.add_argument('--top_n_peaks', default=0, type=int, help='Keep only the N most intense peaks when reducing peaks, 0 keeps all')
+    parser.add_argument('--spectrum_encoding', default="json", help='json for plain [mz, i] lists, binary for base64 encoded arrays')
+    parser.add_argument('--binary_intensity_precision', default="32", help='32 or 64 bit floats for the intensities of the binary encoding, m/z is always 64 bit')
+    parser.add_argument('--binary_compression', default="zlib", help='zlib or none for the binary encoding')
+    parser.add_argument('--mz_delta', default="No", help='Yes to delta encode the m/z values in the binary encoding')
+    parser.add_argument('--stream_output', default=None, help='JSON lines file or named pipe that every record is written to as soon as it is extracted')
+    parser.add_argument('--shard', default=None, help='Shard JSON from shard_metadata.py, only its rows are extracted')
 
     args = parser.parse_args()
 
@@ -152,6 +176,14 @@ def main():
 
     all_rows = metadata_df.to_dict('records')
 
+    if args.shard is not None:
+        # Keeping track of the original row so the shards can be merged back in order
+        shard_rows = json.load(open(args.shard))["rows"]
+        for row_index, record in enumerate(all_rows):
+            record["_metadata_row"] = row_index
+        all_rows = [all_rows[row_index] for row_index in shard_rows]
+        print("Extracting {} metadata rows from shard {}".format(len(all_rows), args.shard))
+
     # TODO: We should limit the column names
     columns_possible = ["Filename", "Scan/Coordinate", "Strain name"]
 
@@ -170,7 +202,18 @@ def main():
         sys.exit(1)
 
 
-    for record in all_rows:
+    loaded_filename = None
+
+    stream_file = None
+    if args.stream_output is not None:
+        # Exiting with the SIGPIPE status like a shell pipeline when the reader goes away, so that the
+        # caller can tell a failed deposit apart from a failed extraction
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        stream_file = open(args.stream_output, "w")
+
+    # Visiting the rows file by file so each file is loaded and indexed once, the records are
+    # updated in place so the output keeps the order of the metadata
+    for record in sorted(all_rows, key=lambda record: str(record["Filename"])):
         # checking if file is NaN
         if pd.isnull(record["Filename"]):
             continue
@@ -178,9 +221,19 @@ def main():
         filename = os.path.join(args.input_spectra_folder, record["Filename"])
 
         if not os.path.exists(filename):
+            print("Spectra file not found, skipping", record["Filename"])
             continue
 
-        ms1_df, ms2_df = load_data(filename)
+        if filename != loaded_filename:
+            ms1_df, ms2_df = load_data(filename)
+            task_profile.count("input_files")
+            loaded_filename = filename
+
+            if len(ms1_df) > 0:
+                with task_profile.timer("indexing"):
+                    # Row positions of every scan, and the positions of the scans for coordinate queries
+                    scan_positions = ms1_df.groupby("scan").indices
+                    coordinate_index = CoordinateIndex(list(scan_positions.keys()))
 
         if len(ms1_df) == 0:
             print("Peaks Empty, skipping", filename)
@@ -190,38 +243,71 @@ def main():
 
         spectra_list = []
 
-        if scan_or_coord == "*":
-            print("Grabbing all scans")
-            
-            # Splitting by scan
-            scan_groups = ms1_df.groupby("scan")
-            for scan, scan_df in scan_groups:
-                peaks_list = scan_df.to_dict('records')
-                peaks_list = [[peak["mz"], peak["i"]] for peak in peaks_list]
-                # Filtering by m/z range
-                peaks_list = [peak for peak in peaks_list if min_mz <= peak[0] <= max_mz]
+        with task_profile.timer("extract"):
+            if scan_or_coord == "*":
+                print("Grabbing all scans")
+                
+                # Splitting by scan
+                for scan, positions in scan_positions.items():
+                    peaks_list = get_peaks_list(ms1_df.iloc[positions], min_mz, max_mz)
 
-                print("SCAN and length of peaks", scan, len(peaks_list))
+                    print("SCAN and length of peaks", scan, len(peaks_list))
 
-                spectra_list.append(peaks_list)
+                    spectra_list.append(peaks_list)
 
-            print(f"Fetched a total of {len(spectra_list)} scans")
-        else:
-            print("Grabbing {} scans".format(scan_or_coord))
-
-            peaks_df = ms1_df[ms1_df["scan"] == scan_or_coord]
-            peaks_list = peaks_df.to_dict('records')
-            peaks_list = [[peak["mz"], peak["i"]] for peak in peaks_list]
-            # Filtering by m/z range
-            peaks_list = [peak for peak in peaks_list if min_mz <= peak[0] <= max_mz]
+                print(f"Fetched a total of {len(spectra_list)} scans")
+            else:
+                print("Grabbing {} scans".format(scan_or_coord))
+
+                matched_scans = coordinate_index.query(scan_or_coord)
+                for scan in matched_scans:
+                    spectra_list.append(get_peaks_list(ms1_df.iloc[scan_positions[scan]], min_mz, max_mz))
+
+                if len(matched_scans) == 0:
+                    print("No scans found for", scan_or_coord)
+                    spectra_list.append([])
+                elif len(matched_scans) > 1:
+                    print(f"Fetched a total of {len(spectra_list)} scans")
+
+        if args.reduce_peaks == "Yes":
+            original_peak_count = sum(len(peaks_list) for peaks_list in spectra_list)
+            task_profile.count("peaks_before_reduction", original_peak_count)
+
+            with task_profile.timer("reduce"):
+                spectra_list = [reduce_peaks(peaks_list, snr=args.peak_snr, half_window=args.peak_half_window,
+                                             min_intensity=args.min_peak_intensity, top_n=args.top_n_peaks,
+                                             baseline_half_window=args.baseline_half_window) for peaks_list in spectra_list]
+
+            reduced_peak_count = sum(len(peaks_list) for peaks_list in spectra_list)
+            if reduced_peak_count > 0:
+                print("Reduced peaks from {} to {} ({:.1f}x)".format(original_peak_count, reduced_peak_count, original_peak_count / reduced_peak_count))
+            else:
+                print("Reduced peaks from {} to 0".format(original_peak_count))
 
-            spectra_list.append(peaks_list)
+        task_profile.count("scans", len(spectra_list))
+        task_profile.count("peaks", sum(len(peaks_list) for peaks_list in spectra_list))
 
         record["spectrum"] = spectra_list
 
+        if args.spectrum_encoding == "binary":
+            with task_profile.timer("encode"):
+                spectrum_encoding.encode_record(record, intensity_precision=args.binary_intensity_precision,
+                                                compression=args.binary_compression, mz_delta=args.mz_delta == "Yes")
+
+        if stream_file is not None:
+            with task_profile.timer("stream"):
+                stream_file.write(json.dumps({k: v for k, v in record.items() if k != "_metadata_row"}) + "\n")
+                stream_file.flush()
+
+    if stream_file is not None:
+        stream_file.write(json.dumps({spectrum_encoding.END_OF_STREAM_KEY: True}) + "\n")
+        stream_file.close()
+
     # Outputting the JSON
     output_json = os.path.join(args.output_folder, args.output_identifier + ".json")
-    open(output_json, "w").write(json.dumps(all_rows, indent=4))
+    with task_profile.timer("serialize"):
+        open(output_json, "w").write(json.dumps(all_rows, indent=4))
+    task_profile.count("bytes_written", os.path.getsize(output_json))
 
     # Outputting the Summary 
     summary_df = pd.DataFrame(all_rows)
@@ -233,6 +319,13 @@ def main():
     output_extraction_tsv = os.path.join(args.output_folder, args.output_identifier + ".tsv")
     summary_df.to_csv(output_extraction_tsv, sep="\t", index=False)
 
+    if args.reduce_peaks == "Yes":
+        counters = task_profile.get_profile("processing_spectra")["counters"]
+        if counters.get("peaks", 0) > 0:
+            print("Overall peak reduction ratio: {:.1f}x".format(counters["peaks_before_reduction"] / counters["peaks"]))
+
+    task_profile.write_profile(args.profile_output, "processing_spectra")
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -11,11 +11,15 @@ from scipy import signal
 from pybaselines import Baseline
 from scipy import signal, interpolate
 
+import task_profile
+import fast_mzml
+
 
 def find_integer_at_end(string):
     return int(re.search(r'\d+$', string).group()) if re.search(r'\d+$', string) else 'N/A'
 
 
+@task_profile.timed("baseline")
 def baseline_als(y, lam=1e5, p=0.01):
     """Asymmetric Least Squares Smoothing for baseline correction (MicrobeMS uses AsLS)."""
     baseline_fitter = Baseline(y)
@@ -150,6 +154,7 @@ def calculate_logistic_threshold(mz, noise_std, sensitivity_factor=3):
     
     return threshold_curve * sensitivity_factor
 
+@task_profile.timed("scoring")
 def microbe_ms_style_qc(mz, intensity, weights={'peaks': 0.55, 'noise': 0.30, 'baseline': 0.00, 'res': 0.15}):
     """Implements a QC scoring system inspired by MicrobeMS metrics for protein spectra.
     
@@ -241,6 +246,7 @@ def main():
     parser = argparse.ArgumentParser(description="QC for protein spectra using MicrobeMS-style metrics")
     parser.add_argument('--input_spectra', help='Path to input spectra file (e.g., mzML)')
     parser.add_argument('--output_path', help='Path to save QC .tsv report')
+    parser.add_argument('--profile_output', default=None, help='Path to write a JSON performance profile of this task')
     args = parser.parse_args()
 
     input_file = Path(args.input_spectra)
@@ -251,38 +257,49 @@ def main():
     if not output_file.parent.exists():
         output_file.parent.mkdir(parents=True, exist_ok=True)
 
-    with mzml.MzML(str(input_file)) as reader:
-        with open(output_file, 'w', encoding='utf-8') as output_csv:
-            headers = ['original_filename', 'scan', 'Total QC Score', 'Status', 'Peaks Score', 'Noise Score', 'Baseline Score', 'Resolving Power Score']
-            output_writer = csv.DictWriter(output_csv, fieldnames=headers)
-            output_writer.writeheader()
-            for scan in reader:
-                mz = scan['m/z array']
-                intensity = scan['intensity array']
-                try:
-                    qc_results = microbe_ms_style_qc(mz, intensity)
-                except Exception as e:
-                    logging.error(f"Error processing scan {scan['id']} in file {input_file.name}: {e}")
-                    qc_results = {
-                        'Total QC Score': 'Error',
-                        'Status': 'Error',
-                        'Sub-Scores': {
-                            'Peaks': 'Error',
-                            'Noise': 'Error',
-                            'Baseline': 'Error',
-                            'Resolving Power': 'Error'
-                        }
+    # Spectra are read lazily, so only the time spent fetching each one counts as parsing
+    all_spectra = fast_mzml.load_spectra(input_file)
+
+    with open(output_file, 'w', encoding='utf-8') as output_csv:
+        headers = ['original_filename', 'scan', 'Total QC Score', 'Status', 'Peaks Score', 'Noise Score', 'Baseline Score', 'Resolving Power Score']
+        output_writer = csv.DictWriter(output_csv, fieldnames=headers)
+        output_writer.writeheader()
+        while True:
+            with task_profile.timer("parse"):
+                scan = next(all_spectra, None)
+            if scan is None:
+                break
+
+            mz = scan['m/z array']
+            intensity = scan['intensity array']
+            task_profile.count("scans")
+            task_profile.count("peaks", len(mz))
+            try:
+                qc_results = microbe_ms_style_qc(mz, intensity)
+            except Exception as e:
+                logging.error(f"Error processing scan {scan['id']} in file {input_file.name}: {e}")
+                qc_results = {
+                    'Total QC Score': 'Error',
+                    'Status': 'Error',
+                    'Sub-Scores': {
+                        'Peaks': 'Error',
+                        'Noise': 'Error',
+                        'Baseline': 'Error',
+                        'Resolving Power': 'Error'
                     }
-                output_writer.writerow({
-                    'original_filename': input_file.name,
-                    'scan': find_integer_at_end(scan['id']),
-                    'Total QC Score': qc_results['Total QC Score'],
-                    'Status': qc_results['Status'],
-                    'Peaks Score': qc_results['Sub-Scores']['Peaks'],
-                    'Noise Score': qc_results['Sub-Scores']['Noise'],
-                    'Baseline Score': qc_results['Sub-Scores']['Baseline'],
-                    'Resolving Power Score': qc_results['Sub-Scores']['Resolving Power']
-                })
+                }
+            output_writer.writerow({
+                'original_filename': input_file.name,
+                'scan': find_integer_at_end(scan['id']),
+                'Total QC Score': qc_results['Total QC Score'],
+                'Status': qc_results['Status'],
+                'Peaks Score': qc_results['Sub-Scores']['Peaks'],
+                'Noise Score': qc_results['Sub-Scores']['Noise'],
+                'Baseline Score': qc_results['Sub-Scores']['Baseline'],
+                'Resolving Power Score': qc_results['Sub-Scores']['Resolving Power']
+            })
+
+    task_profile.write_profile(args.profile_output, "qc_protein_spectra")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
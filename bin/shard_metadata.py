@@ -0,0 +1,75 @@
+import os
+import argparse
+import json
+import pandas as pd
+
+from convert_metadata import load_metadata_file
+
+
+def shard_rows_by_filename(metadata_df, num_shards):
+    """
+    Splits the metadata rows into shards, keeping all rows of the same file in one shard
+    so that every spectra file only has to be staged and parsed once.
+
+    Args:
+    metadata_df: pd.DataFrame, metadata
+    num_shards: int, maximum number of shards
+
+    Returns:
+    all_shards: list, each shard is a dict with the sorted row indices and the filenames it needs
+
+    Raises:
+    ValueError: if a Filename is absolute or points outside of the spectra folder
+    """
+    # Grouping the rows by filename, rows without a filename are kept together
+    filename_groups = {}
+    for row_index, filename in enumerate(metadata_df["Filename"]):
+        key = None if pd.isnull(filename) else str(filename)
+        if key is not None and (os.path.isabs(key) or ".." in key.replace("\\", "/").split("/")):
+            raise ValueError(f"Filename must be relative to the spectra folder, but got {key} in row {row_index}")
+        filename_groups.setdefault(key, []).append(row_index)
+
+    # Largest groups first, ties broken by the first row so the result is deterministic
+    all_groups = sorted(filename_groups.items(), key=lambda item: (-len(item[1]), item[1][0]))
+
+    num_shards = max(1, min(num_shards, len(all_groups)))
+    all_shards = [{"rows": [], "files": []} for i in range(num_shards)]
+
+    for filename, row_indices in all_groups:
+        smallest_shard = min(all_shards, key=lambda shard: len(shard["rows"]))
+        smallest_shard["rows"] += row_indices
+        if filename is not None:
+            smallest_shard["files"].append(filename)
+
+    for shard in all_shards:
+        shard["rows"].sort()
+        shard["files"].sort()
+
+    return all_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split the metadata into shards grouped by Filename.')
+    parser.add_argument('input_metadata')
+    parser.add_argument('output_folder')
+    parser.add_argument('--num_shards', default=1, type=int)
+
+    args = parser.parse_args()
+
+    metadata_df = load_metadata_file(args.input_metadata)
+    metadata_df.columns = metadata_df.columns.str.strip()
+
+    if not "Filename" in metadata_df.columns:
+        raise ValueError("Filename column not found in metadata")
+
+    all_shards = shard_rows_by_filename(metadata_df, args.num_shards)
+
+    for shard_index, shard in enumerate(all_shards):
+        print("Shard {} has {} rows and {} files".format(shard_index, len(shard["rows"]), len(shard["files"])))
+
+        output_shard = os.path.join(args.output_folder, "shard_{:04d}.json".format(shard_index))
+        open(output_shard, "w").write(json.dumps(shard, indent=4))
+
+
+if __name__ == "__main__":
+    main()
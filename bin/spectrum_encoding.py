@@ -0,0 +1,116 @@
+import base64
+import zlib
+import numpy as np
+
+# Value of the "Spectrum encoding" field of a record, records without it hold plain [mz, i] lists
+BINARY_ENCODING = "binary"
+
+# Key of the last line of a JSON lines stream of records, written by processing_spectra.py and checked by deposit_spectra.py
+END_OF_STREAM_KEY = "_end_of_stream"
+
+DTYPES = {
+    "32": "float32",
+    "64": "float64",
+}
+
+
+def _little_endian(dtype):
+    return np.dtype(dtype).newbyteorder("<")
+
+
+def _encode_array(array, dtype, compression):
+    raw_bytes = np.asarray(array, dtype=_little_endian(dtype)).tobytes()
+    if compression == "zlib":
+        raw_bytes = zlib.compress(raw_bytes)
+    return base64.b64encode(raw_bytes).decode("ascii")
+
+
+def _decode_array(encoded, dtype, compression):
+    raw_bytes = base64.b64decode(encoded)
+    if compression == "zlib":
+        raw_bytes = zlib.decompress(raw_bytes)
+    return np.frombuffer(raw_bytes, dtype=_little_endian(dtype))
+
+
+def encode_peaks(peaks_list, intensity_precision="32", compression="zlib", mz_delta=False):
+    """
+    Encodes a list of [mz, i] pairs as base64 binary arrays, in the spirit of mzML.
+
+    m/z values are always stored as 64 bit floats like in mzML, so the encoding is lossless
+    for them, only the intensities can be stored in 32 bit.
+
+    Args:
+    peaks_list: list, [mz, i] pairs sorted by m/z
+    intensity_precision: str, "32" or "64" bit floats for the intensities
+    compression: str, "zlib" or "none"
+    mz_delta: bool, store the differences between consecutive m/z values, which compress better
+
+    Returns:
+    encoded_spectrum: dict, self describing encoded spectrum
+    """
+    if not intensity_precision in DTYPES:
+        raise ValueError(f"Binary intensity precision must be one of {list(DTYPES.keys())}, but got {intensity_precision} instead.")
+    if not compression in ["zlib", "none"]:
+        raise ValueError(f"Binary compression must be zlib or none, but got {compression} instead.")
+
+    peaks_array = np.asarray(peaks_list, dtype="float64").reshape(-1, 2)
+    mz_array = peaks_array[:, 0]
+    intensity_array = peaks_array[:, 1]
+
+    if mz_delta:
+        mz_array = np.diff(mz_array, prepend=0.0)
+
+    return {
+        "peak_count": len(peaks_array),
+        "mz_dtype": "float64",
+        "intensity_dtype": DTYPES[intensity_precision],
+        "compression": compression,
+        "mz_delta": bool(mz_delta),
+        "mz": _encode_array(mz_array, "float64", compression),
+        "intensity": _encode_array(intensity_array, DTYPES[intensity_precision], compression)
+    }
+
+
+def decode_peaks(encoded_spectrum):
+    """
+    Decodes the output of encode_peaks back into a list of [mz, i] pairs.
+
+    Args:
+    encoded_spectrum: dict, output of encode_peaks
+
+    Returns:
+    peaks_list: list, [mz, i] pairs
+    """
+    mz_array = _decode_array(encoded_spectrum["mz"], encoded_spectrum["mz_dtype"], encoded_spectrum["compression"])
+    intensity_array = _decode_array(encoded_spectrum["intensity"], encoded_spectrum["intensity_dtype"], encoded_spectrum["compression"])
+
+    if encoded_spectrum["mz_delta"]:
+        mz_array = np.cumsum(mz_array)
+
+    return np.column_stack([mz_array.astype("float64"), intensity_array.astype("float64")]).tolist()
+
+
+def encode_record(record, intensity_precision="32", compression="zlib", mz_delta=False):
+    """
+    Encodes the spectrum field of a record in place and records the encoding.
+    """
+    if not "spectrum" in record or record.get("Spectrum encoding") == BINARY_ENCODING:
+        return record
+
+    record["spectrum"] = [encode_peaks(peaks_list, intensity_precision=intensity_precision, compression=compression, mz_delta=mz_delta) for peaks_list in record["spectrum"]]
+    record["Spectrum encoding"] = BINARY_ENCODING
+
+    return record
+
+
+def decode_record(record):
+    """
+    Decodes the spectrum field of a record in place back to plain [mz, i] lists.
+    """
+    if record.get("Spectrum encoding") != BINARY_ENCODING:
+        return record
+
+    record["spectrum"] = [decode_peaks(encoded_spectrum) for encoded_spectrum in record["spectrum"]]
+    record.pop("Spectrum encoding")
+
+    return record
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Module level state so that helpers such as load_data can be instrumented
+# without threading a profile object through every call.
+_start_time = time.perf_counter()
+_stage_seconds = {}
+_stage_calls = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+@contextmanager
+def timer(stage:str):
+    """
+    Context manager that accumulates the wall clock time spent inside the block.
+
+    Stages may be nested, in which case the outer stage includes the inner one. Stages timed
+    from several threads add up the time of every thread.
+
+    Args:
+    stage: str, name of the stage, e.g. "parse", "binning", "upload"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _stage_seconds[stage] = _stage_seconds.get(stage, 0.0) + elapsed
+            _stage_calls[stage] = _stage_calls.get(stage, 0) + 1
+
+
+def timed(stage:str):
+    """
+    Decorator version of timer, times every call of the wrapped function.
+
+    Args:
+    stage: str, name of the stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(counter:str, value=1):
+    """
+    Increments a named counter, e.g. scans, peaks or bytes.
+
+    Args:
+    counter: str, name of the counter
+    value: int, amount to add
+    """
+    with _lock:
+        _counters[counter] = _counters.get(counter, 0) + int(value)
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB, or None when unavailable.
+    """
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        max_rss = max_rss / 1024
+
+    return round(max_rss / 1024, 2)
+
+
+def get_profile(task:str):
+    """
+    Collects the stages, counters and memory usage recorded so far.
+
+    Args:
+    task: str, name of the task, e.g. the script being run
+
+    Returns:
+    profile: dict, JSON serializable profile
+    """
+    stages = {}
+    for stage in _stage_seconds:
+        stages[stage] = {
+            "seconds": round(_stage_seconds[stage], 4),
+            "calls": _stage_calls[stage]
+        }
+
+    return {
+        "task": task,
+        "hostname": os.uname().nodename if hasattr(os, "uname") else "",
+        "wall_seconds": round(time.perf_counter() - _start_time, 4),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+        "counters": dict(_counters)
+    }
+
+
+def write_profile(output_path, task:str):
+    """
+    Writes the profile of this task to a JSON file. Does nothing if output_path is empty.
+
+    Args:
+    output_path: str, path to the output JSON file
+    task: str, name of the task
+    """
+    if not output_path:
+        return
+
+    with open(output_path, "w") as output_file:
+        output_file.write(json.dumps(get_profile(task), indent=4))
+
+
+def reset():
+    """
+    Clears all recorded stages and counters.
+    """
+    global _start_time
+    _start_time = time.perf_counter()
+    _stage_seconds.clear()
+    _stage_calls.clear()
+    _counters.clear()
@@ -8,6 +8,11 @@ params.dryrun = "Yes"
 // Processing Parameters
 params.merge_replicates = "Yes"
 
+// Duplicate detection, the archive holds the signatures of past depositions and is only extended once a real deposition succeeded
+params.dedup_archive = "$launchDir/dedup_archive/dedup_archive.json"
+params.dedup_similarity = 0.98
+params.skip_duplicates = "No"
+
 
 // Workflow Boiler Plate
 params.OMETALINKING_YAML = "flow_filelinking.yaml"
@@ -15,12 +20,46 @@ params.OMETAPARAM_YAML = "job_parameters.yaml"
 
 params.idbac_url = "idbac.org"
 
+// Local snapshot of the existing strain names, refreshed once it is older than the TTL in seconds
+params.existing_names_cache = "$launchDir/existing_names_cache/existing_names.json"
+params.existing_names_ttl = 3600
+
+// Number of shards the metadata extraction is split into
+params.extraction_shards = 4
+
+// Upload spectra while they are extracted instead of after the whole extraction
+params.pipeline_deposit = "No"
+params.deposit_queue_size = 16
+params.upload_workers = 2
+
+// Peak reduction of the deposited spectra
+params.reduce_peaks = "No"
+params.peak_snr = 4
+params.top_n_peaks = 0
+params.min_peak_intensity = 0
+
+// Encoding of the spectrum field in the extraction JSON, json or binary
+params.spectrum_encoding = "json"
+params.upload_encoding = "json"
+
 // Min/Max m/z values for processing
 params.min_mz = ""
 params.max_mz = ""
 
 TOOL_FOLDER = "$baseDir/bin"
 
+// Links every staged spectra file at its Filename under spectra/, files are staged in numbered
+// folders so that Filenames with subdirectories or repeated basenames do not collide
+def link_spectra_commands(spectra_files, spectra_filenames) {
+    def all_files = spectra_files instanceof List ? spectra_files : [spectra_files]
+    def all_commands = ["mkdir -p spectra"]
+    [all_files, spectra_filenames].transpose().each { staged_file, filename ->
+        def quoted_path = "'" + ("spectra/" + filename).replace("'", "'\\''") + "'"
+        all_commands << "mkdir -p \"\$(dirname ${quoted_path})\" && ln -s \"\$PWD/${staged_file}\" ${quoted_path}"
+    }
+    return all_commands.join("\n    ")
+}
+
 process qc_spectra {
     cpus 2
     memory '8 GB'
@@ -32,11 +71,13 @@ process qc_spectra {
 
     output:
     file 'single_file_qc_report.tsv'
+    path 'qc_profile.json', emit: profile
 
     """
     python $TOOL_FOLDER/qc_protein_spectra.py \
     --input_spectra $input_spectra_file \
-    --output_path single_file_qc_report.tsv
+    --output_path single_file_qc_report.tsv \
+    --profile_output qc_profile.json
     """
 }
 
@@ -60,19 +101,35 @@ process merge_qc_tsv {
     """
 }
 
-process processInputDataAndMetadata {
-    publishDir "./nf_output", mode: 'copy'
+process shardMetadata {
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    input:
+    file input_metadata
+
+    output:
+    path 'shards/*.json'
+
+    """
+    mkdir shards
+    python $TOOL_FOLDER/shard_metadata.py $input_metadata shards --num_shards ${params.extraction_shards}
+    """
+}
 
+process processInputDataAndMetadata {
     conda "$TOOL_FOLDER/conda_env_idbac.yml"
 
     input:
     file input_metadata
-    file spectra
+    tuple path(shard), path(spectra_files, stageAs: "staged?/*"), val(spectra_filenames)
 
     output:
-    file 'output_spectra'
+    path 'output_spectra/*.json', emit: extraction
+    path 'extraction_profile.json', emit: profile
 
     """
+    ${link_spectra_commands(spectra_files, spectra_filenames)}
+
     if [ ! -d "output_spectra" ]; then
         mkdir output_spectra
     fi
@@ -87,48 +144,177 @@ process processInputDataAndMetadata {
         echo "processInputDataAndMetadata() Using max_mz: ${params.max_mz}"
     fi
 
-    python $TOOL_FOLDER/processing_spectra.py $input_metadata $spectra output_spectra \$min_mz_flag \$max_mz_flag
+    python $TOOL_FOLDER/processing_spectra.py $input_metadata spectra output_spectra \$min_mz_flag \$max_mz_flag \
+    --reduce_peaks ${params.reduce_peaks} \
+    --peak_snr ${params.peak_snr} \
+    --top_n_peaks ${params.top_n_peaks} \
+    --min_peak_intensity ${params.min_peak_intensity} \
+    --spectrum_encoding ${params.spectrum_encoding} \
+    --shard $shard \
+    --output_identifier ${shard.baseName} \
+    --profile_output extraction_profile.json
     """
 }
 
-process getExistingNames {
+process extractAndDepositSpectra {
+    conda "$TOOL_FOLDER/conda_env_idbac.yml"
+
+    input:
+    file input_metadata
+    tuple path(shard), path(spectra_files, stageAs: "staged?/*"), val(spectra_filenames)
+    file params_file
+    file existing_names
+    file duplicate_report
+
     output:
-    path 'existing_names.txt', emit: existing_names
+    path 'output_spectra/*.json', emit: extraction
+    path 'extraction_profile.json', emit: extraction_profile
+    path 'deposit_profile.json', emit: deposit_profile
 
     """
-    MAX_RETRIES=3
-    TIMEOUT=30
-    URL="${params.idbac_url}/api/get_all_strain_names"
-    OUTPUT_FILE="existing_names.txt"
-
-    # Retry logic
-    for ((i=1; i<=MAX_RETRIES; i++))
-    do
-        echo "Attempt \$i of \$MAX_RETRIES..."
-        
-        # Run wget with timeout
-        wget --timeout=\$TIMEOUT \$URL -O \$OUTPUT_FILE
-        
-        # Check if the wget command was successful
-        if [ \$(echo \$?) -eq 0 ]; then
-            echo "Download successful."
-            break
-        else
-            echo "Download failed. Retrying in \$TIMEOUT seconds..."
-            sleep \$TIMEOUT
+    ${link_spectra_commands(spectra_files, spectra_filenames)}
+
+    if [ ! -d "output_spectra" ]; then
+        mkdir output_spectra
+    fi
+    min_mz_flag=""
+    max_mz_flag=""
+    if [ ! -z "${params.min_mz}" ]; then
+        min_mz_flag="--min_mz ${params.min_mz}"
+        echo "extractAndDepositSpectra() Using min_mz: ${params.min_mz}"
+    fi
+    if [ ! -z "${params.max_mz}" ]; then
+        max_mz_flag="--max_mz ${params.max_mz}"
+        echo "extractAndDepositSpectra() Using max_mz: ${params.max_mz}"
+    fi
+
+    # The extraction writes every record to the pipe as soon as it is done, the deposit uploads them concurrently
+    mkfifo spectra_stream.jsonl
+
+    python $TOOL_FOLDER/deposit_spectra.py \
+    --stream_input spectra_stream.jsonl \
+    --metadata $input_metadata \
+    --params $params_file \
+    --dryrun $params.dryrun \
+    --existing_names existing_names.txt \
+    --duplicate_report $duplicate_report \
+    --skip_duplicates ${params.skip_duplicates} \
+    --spectrum_encoding ${params.upload_encoding} \
+    --queue_size ${params.deposit_queue_size} \
+    --upload_workers ${params.upload_workers} \
+    --refresh_database No \
+    --profile_output deposit_profile.json &
+    deposit_pid=\$!
+
+    python $TOOL_FOLDER/processing_spectra.py $input_metadata spectra output_spectra \$min_mz_flag \$max_mz_flag \
+    --reduce_peaks ${params.reduce_peaks} \
+    --peak_snr ${params.peak_snr} \
+    --top_n_peaks ${params.top_n_peaks} \
+    --min_peak_intensity ${params.min_peak_intensity} \
+    --spectrum_encoding ${params.spectrum_encoding} \
+    --shard $shard \
+    --output_identifier ${shard.baseName} \
+    --stream_output spectra_stream.jsonl \
+    --profile_output extraction_profile.json &
+    extraction_pid=\$!
+
+    # Never leaving one side behind, e.g. blocked on opening the pipe after the other side failed before opening it
+    trap 'kill \$deposit_pid \$extraction_pid 2> /dev/null || true' EXIT
+
+    while kill -0 \$deposit_pid 2> /dev/null && kill -0 \$extraction_pid 2> /dev/null; do
+        sleep 1
+    done
+
+    deposit_status=0
+    extraction_status=0
+    if ! kill -0 \$extraction_pid 2> /dev/null; then
+        wait \$extraction_pid || extraction_status=\$?
+
+        # 141 is SIGPIPE, the deposit closed the pipe and its own status tells why
+        if [ \$extraction_status -ne 0 ] && [ \$extraction_status -ne 141 ]; then
+            kill \$deposit_pid 2> /dev/null || true
+            wait \$deposit_pid || true
+            echo "extractAndDepositSpectra() Extraction failed with status \$extraction_status"
+            exit \$extraction_status
         fi
-        
-        # If the last attempt fails, print an error message
-        if [ \$i -eq \$MAX_RETRIES ]; then
-            echo "Failed to download after \$MAX_RETRIES attempts."
+
+        wait \$deposit_pid || deposit_status=\$?
+    else
+        wait \$deposit_pid || deposit_status=\$?
+
+        if [ \$deposit_status -ne 0 ]; then
+            kill \$extraction_pid 2> /dev/null || true
+            wait \$extraction_pid || true
+        else
+            wait \$extraction_pid || extraction_status=\$?
         fi
-    done
+    fi
+
+    # Checking the deposit first, when it fails the extraction only sees a closed pipe
+    if [ \$deposit_status -ne 0 ]; then
+        echo "extractAndDepositSpectra() Deposit failed with status \$deposit_status"
+        exit \$deposit_status
+    fi
+    if [ \$extraction_status -ne 0 ]; then
+        echo "extractAndDepositSpectra() Extraction failed with status \$extraction_status"
+        exit \$extraction_status
+    fi
     """
 }
 
-process depositSpectrum {
+process refreshDatabase {
+    conda "$TOOL_FOLDER/conda_env_idbac.yml"
+
+    input:
+    file params_file
+    file existing_names
+    val deposit_profiles
+
+    output:
+    val 1, emit: done
+
+    """
+    python $TOOL_FOLDER/deposit_spectra.py \
+    --params $params_file \
+    --dryrun $params.dryrun \
+    --existing_names existing_names.txt
+    """
+}
+
+process mergeExtractionShards {
     publishDir "./nf_output", mode: 'copy'
 
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    input:
+    path shard_json_files, stageAs: "shards/*"
+
+    output:
+    file 'output_spectra'
+
+    """
+    mkdir output_spectra
+    python $TOOL_FOLDER/merge_extraction_shards.py shards output_spectra
+    """
+}
+
+process getExistingNames {
+    conda "$TOOL_FOLDER/conda_env_idbac.yml"
+
+    // The task has no inputs, so a resumed run would otherwise reuse the first list forever, freshness is left to --ttl
+    cache false
+
+    output:
+    path 'existing_names.txt', emit: existing_names
+
+    """
+    python $TOOL_FOLDER/existing_names.py ${params.idbac_url} existing_names.txt \
+    --cache ${params.existing_names_cache} \
+    --ttl ${params.existing_names_ttl}
+    """
+}
+
+process depositSpectrum {
     conda "$TOOL_FOLDER/conda_env_idbac.yml"
 
     input:
@@ -136,12 +322,20 @@ process depositSpectrum {
     file params_file
     file existing_names
     val dummy
+    file duplicate_report
+
+    output:
+    path 'deposit_profile.json', emit: profile
 
     """
     python $TOOL_FOLDER/deposit_spectra.py $input_spectra_json \
     --params $params_file \
     --dryrun $params.dryrun \
-    --existing_names existing_names.txt
+    --existing_names existing_names.txt \
+    --duplicate_report $duplicate_report \
+    --skip_duplicates ${params.skip_duplicates} \
+    --spectrum_encoding ${params.upload_encoding} \
+    --profile_output deposit_profile.json
     """
 }
 
@@ -180,7 +374,7 @@ process baselineCorrection {
 }
 
 process mergeInputSpectra {
-    publishDir "./nf_output", mode: 'copy'
+    publishDir "./nf_output", mode: 'copy', pattern: '{merged/*.mzML,merged_feature_matrix.npz}'
 
     conda "$TOOL_FOLDER/conda_env.yml"
 
@@ -190,6 +384,8 @@ process mergeInputSpectra {
     output:
     file 'merged/*.mzML'
     val 1
+    path 'merge_profile.json', emit: profile
+    path 'merged_feature_matrix.npz', emit: feature_matrix
 
     """
     mkdir merged
@@ -210,7 +406,71 @@ process mergeInputSpectra {
     input_spectra \
     merged \
     --merge_replicates ${params.merge_replicates} \
-    \$min_mz_flag \$max_mz_flag
+    \$min_mz_flag \$max_mz_flag \
+    --feature_matrix merged_feature_matrix.npz \
+    --profile_output merge_profile.json
+    """
+}
+
+process detectDuplicateSpectra {
+    publishDir "./nf_output/dedup", mode: 'copy', pattern: '{duplicate_report.tsv,dedup_candidates.json}'
+
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    input:
+    file "merged/*"
+    file input_metadata
+
+    output:
+    path 'duplicate_report.tsv', emit: report
+    path 'dedup_candidates.json', emit: candidates
+    path 'dedup_profile.json', emit: profile
+
+    """
+    python $TOOL_FOLDER/dedup_spectra.py \
+    merged \
+    duplicate_report.tsv \
+    --metadata $input_metadata \
+    --similarity_threshold ${params.dedup_similarity} \
+    --archive "${params.dedup_archive}" \
+    --output_candidates dedup_candidates.json \
+    --profile_output dedup_profile.json
+    """
+}
+
+process commitDedupArchive {
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    cache false
+
+    input:
+    file dedup_candidates
+    val deposit_done
+
+    """
+    python $TOOL_FOLDER/commit_dedup_archive.py \
+    $dedup_candidates \
+    "${params.dedup_archive}"
+    """
+}
+
+process mergeProfiles {
+    publishDir "./nf_output/profile", mode: 'copy'
+
+    conda "$TOOL_FOLDER/conda_env.yml"
+
+    input:
+    path profile_files, stageAs: "profiles/profile_*.json"
+
+    output:
+    path "run_profile.json"
+    path "run_profile_stages.tsv"
+
+    """
+    python $TOOL_FOLDER/merge_profiles.py \
+    profiles \
+    run_profile.json \
+    run_profile_stages.tsv
     """
 }
 
@@ -218,10 +478,9 @@ process mergeInputSpectra {
 workflow {
     input_metadata_ch = Channel.fromPath(params.input_metadata)
     input_spectra_ch = Channel.fromPath(params.input_spectra_folder + "/*.mzML")
-    input_spectra_folder_ch = Channel.fromPath(params.input_spectra_folder)
 
     // Perform protein-specific QC
-    qc_reports = qc_spectra(
+    (qc_reports, qc_profiles) = qc_spectra(
         input_spectra_ch,
     )
     // Merge QC reports into a single file for easier review
@@ -232,7 +491,13 @@ workflow {
     showMetadata(input_metadata_ch)
 
     // Processing data
-    _spectra_json_ch = processInputDataAndMetadata(input_metadata_ch, input_spectra_folder_ch)
+    // Splitting the metadata by Filename so each shard only stages the spectra it needs
+    shards_ch = shardMetadata(input_metadata_ch).flatten().map { shard_file ->
+        def shard = new groovy.json.JsonSlurper().parse(shard_file.toFile())
+        def shard_filenames = shard.files.findAll { file(params.input_spectra_folder + "/" + it).exists() }
+        (shard.files - shard_filenames).each { log.warn "Spectra file not found, its metadata rows are skipped: ${it}" }
+        tuple(shard_file, shard_filenames.collect { file(params.input_spectra_folder + "/" + it) }, shard_filenames)
+    }
 
     getExistingNames()
 
@@ -244,9 +509,44 @@ workflow {
     input_mzml_files_ch = Channel.fromPath(params.input_spectra_folder + "/*.mzML")
     baseline_query_spectra_ch = baselineCorrection(input_mzml_files_ch)
 
-    // Doing merging of spectra
-    (merged_spectra_ch, dummy) = mergeInputSpectra(baseline_query_spectra_ch.collect())
+    // Doing merging of spectra, the feature matrix is only published
+    (merged_spectra_ch, dummy, merge_profile_ch) = mergeInputSpectra(baseline_query_spectra_ch.collect())
     
-    // Doing Deposition
-    depositSpectrum(_spectra_json_ch, input_params_ch, getExistingNames.out.existing_names, dummy)
+    // Flagging duplicates within the submission, repeated metadata rows and against the archive of past depositions
+    detectDuplicateSpectra(merged_spectra_ch, input_metadata_ch)
+
+    if (params.pipeline_deposit == "Yes") {
+        // Only waiting for the merge and the duplicate report when duplicates have to be skipped,
+        // otherwise the extraction starts right away and the report is only published
+        if (params.skip_duplicates == "Yes") {
+            duplicate_report_ch = detectDuplicateSpectra.out.report.first()
+        }
+        else {
+            duplicate_report_ch = Channel.value(file("$TOOL_FOLDER/empty_duplicate_report.tsv"))
+        }
+
+        // Doing Deposition while every shard is extracted, the knowledgebase is refreshed once at the end
+        (shard_json_ch, extraction_profile_ch, deposit_profile_ch) = extractAndDepositSpectra(input_metadata_ch.first(), shards_ch, input_params_ch.first(), getExistingNames.out.existing_names.first(), duplicate_report_ch)
+        _spectra_json_ch = mergeExtractionShards(shard_json_ch.collect())
+        refreshDatabase(input_params_ch, getExistingNames.out.existing_names, deposit_profile_ch.collect())
+        deposit_done_ch = refreshDatabase.out.done
+    }
+    else {
+        (shard_json_ch, extraction_profile_ch) = processInputDataAndMetadata(input_metadata_ch.first(), shards_ch)
+        _spectra_json_ch = mergeExtractionShards(shard_json_ch.collect())
+
+        // Doing Deposition
+        depositSpectrum(_spectra_json_ch, input_params_ch, getExistingNames.out.existing_names, dummy, detectDuplicateSpectra.out.report)
+        deposit_profile_ch = depositSpectrum.out.profile
+        deposit_done_ch = depositSpectrum.out.profile.collect()
+    }
+
+    // Only archiving the signatures of spectra that were really deposited, so a failed run can be retried
+    if (params.dryrun == "No" && params.dedup_archive) {
+        commitDedupArchive(detectDuplicateSpectra.out.candidates, deposit_done_ch)
+    }
+
+    // Aggregating the per-task performance profiles into a run level report
+    all_profiles_ch = qc_profiles.mix(extraction_profile_ch, merge_profile_ch, detectDuplicateSpectra.out.profile, deposit_profile_ch)
+    mergeProfiles(all_profiles_ch.collect())
 }
\ No newline at end of file
@@ -0,0 +1,65 @@
+import base64
+import zlib
+
+import numpy as np
+
+ARRAY_ACCESSIONS = {
+    "m/z array": ("MS:1000514", "m/z array"),
+    "intensity array": ("MS:1000515", "intensity array"),
+}
+
+DTYPE_ACCESSIONS = {
+    "float32": ("MS:1000521", "32-bit float"),
+    "float64": ("MS:1000523", "64-bit float"),
+}
+
+
+def _cv_param(accession, name, value=""):
+    return '<cvParam cvRef="MS" accession="{}" name="{}" value="{}"/>'.format(accession, name, value)
+
+
+def _binary_data_array(array, array_name, dtype, compressed, param_group=None):
+    raw_bytes = np.asarray(array, dtype=np.dtype(dtype).newbyteorder("<")).tobytes()
+    if compressed:
+        raw_bytes = zlib.compress(raw_bytes)
+    encoded = base64.b64encode(raw_bytes).decode("ascii")
+
+    if param_group is not None:
+        all_params = '<referenceableParamGroupRef ref="{}"/>'.format(param_group)
+    else:
+        all_params = "".join([
+            _cv_param(*DTYPE_ACCESSIONS[dtype]),
+            _cv_param("MS:1000574", "zlib compression") if compressed else _cv_param("MS:1000576", "no compression"),
+            _cv_param(*ARRAY_ACCESSIONS[array_name]),
+        ])
+
+    return '<binaryDataArray encodedLength="{}">{}<binary>{}</binary></binaryDataArray>'.format(len(encoded), all_params, encoded)
+
+
+def write_mzml(output_filename, all_spectra, mz_param_group=False, param_group_from=0):
+    """
+    Writes a minimal mzML, all_spectra holds (m/z array, intensity array, intensity dtype, zlib compressed) tuples.
+    With mz_param_group, the m/z arrays from the param_group_from spectrum on use a referenceableParamGroupRef.
+    """
+    all_spectrum_xml = []
+    for index, (mz_array, intensity_array, dtype, compressed) in enumerate(all_spectra):
+        use_param_group = mz_param_group and index >= param_group_from
+        all_arrays = [
+            # The param group declares uncompressed 64 bit m/z arrays
+            _binary_data_array(mz_array, "m/z array", "float64", compressed and not use_param_group, param_group="mz_params" if use_param_group else None),
+            _binary_data_array(intensity_array, "intensity array", dtype, compressed),
+        ]
+        all_spectrum_xml.append(
+            '<spectrum index="{}" id="scan={}" defaultArrayLength="{}">{}<binaryDataArrayList count="2">{}</binaryDataArrayList></spectrum>'.format(
+                index, index + 1, len(mz_array), _cv_param("MS:1000511", "ms level", "1"), "".join(all_arrays)))
+
+    param_group_xml = ('<referenceableParamGroupList count="1"><referenceableParamGroup id="mz_params">{}{}{}</referenceableParamGroup></referenceableParamGroupList>'.format(
+        _cv_param(*DTYPE_ACCESSIONS["float64"]), _cv_param("MS:1000576", "no compression"), _cv_param(*ARRAY_ACCESSIONS["m/z array"])))
+
+    with open(output_filename, "w") as output_file:
+        output_file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        output_file.write('<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">')
+        output_file.write('<cvList count="1"><cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/></cvList>')
+        if mz_param_group:
+            output_file.write(param_group_xml)
+        output_file.write('<run id="run"><spectrumList count="{}">{}</spectrumList></run></mzML>'.format(len(all_spectra), "".join(all_spectrum_xml)))
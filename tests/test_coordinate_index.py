@@ -0,0 +1,27 @@
+from coordinate_index import CoordinateIndex, parse_coordinate
+
+
+def test_scan_index_suffix_is_ignored():
+    assert parse_coordinate("B12_0") == (12.0, 2.0)
+    assert parse_coordinate("R00X012Y034_4") == (12.0, 34.0)
+    assert parse_coordinate("scan_1") is None
+
+
+def test_queries_match_load_data_scan_names():
+    coordinate_index = CoordinateIndex(["A1_0", "A2_1", "B1_2", "B12_3", "R00X012Y034_4"])
+
+    assert coordinate_index.query("B12") == ["B12_3"]
+    assert coordinate_index.query("B12_3") == ["B12_3"]
+    assert coordinate_index.query("A1:B2") == ["A1_0", "A2_1", "B1_2"]
+    assert coordinate_index.query("circle(12, 34, 0.5)") == ["R00X012Y034_4"]
+    assert coordinate_index.query("C1") == []
+
+
+def test_large_rectangle_matches_brute_force():
+    all_scan_names = ["X{}Y{}".format(x, y) for x in range(0, 60, 3) for y in range(0, 60, 7)]
+    coordinate_index = CoordinateIndex(all_scan_names)
+
+    for x1, y1, x2, y2 in [(-1000000, -1000000, 1000000, 1000000), (10, 5, 31, 1000000), (4.5, 4.5, 5.5, 5.5)]:
+        expected_scans = [scan_name for scan_name in all_scan_names
+                          if x1 <= parse_coordinate(scan_name)[0] <= x2 and y1 <= parse_coordinate(scan_name)[1] <= y2]
+        assert coordinate_index.rectangle(x1, y1, x2, y2) == expected_scans
@@ -0,0 +1,127 @@
+import csv
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+import dedup_spectra
+from mzml_helpers import write_mzml
+
+MZ_ARRAY = np.arange(2000.0, 20000.0, 10.0)
+
+
+def _spectrum(seed):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, 1000, len(MZ_ARRAY)) * (rng.uniform(0, 1, len(MZ_ARRAY)) > 0.8)
+
+
+def _entry(filename, scan, intensity_array, source="submission"):
+    return {
+        "filename": filename,
+        "scan": scan,
+        "source": source,
+        "signature": dedup_spectra.compute_signature(MZ_ARRAY, intensity_array, 10.0)
+    }
+
+
+def test_signature_ignores_intensity_scale():
+    intensity_array = _spectrum(0)
+
+    signature = dedup_spectra.compute_signature(MZ_ARRAY, intensity_array, 10.0)
+
+    assert dedup_spectra.compute_signature(MZ_ARRAY, intensity_array * 3.0, 10.0)["digest"] == signature["digest"]
+    assert dedup_spectra.compute_signature(MZ_ARRAY, _spectrum(1), 10.0)["digest"] != signature["digest"]
+    assert abs(sum(weight ** 2 for weight in signature["weights"]) - 1.0) < 1e-4
+
+
+def test_index_exact_near_and_unique():
+    intensity_array = _spectrum(0)
+    index = dedup_spectra.SignatureIndex()
+    index.add(_entry("a.mzML", "scan=1", intensity_array))
+
+    entry, similarity, match_type = index.query(_entry("b.mzML", "scan=1", intensity_array)["signature"], 0.98)
+    assert (entry["filename"], similarity, match_type) == ("a.mzML", 1.0, "exact")
+
+    # A small change in one peak keeps it above the threshold
+    near_intensity_array = intensity_array.copy()
+    near_intensity_array[np.argmax(near_intensity_array > 0)] *= 1.2
+    entry, similarity, match_type = index.query(_entry("b.mzML", "scan=1", near_intensity_array)["signature"], 0.98)
+    assert entry["filename"] == "a.mzML"
+    assert match_type == "near"
+    assert 0.98 <= similarity < 1.0
+
+    assert index.query(_entry("c.mzML", "scan=1", _spectrum(1))["signature"], 0.98) is None
+
+
+def test_commit_archive_keeps_existing_signatures(tmp_path):
+    archive_path = str(tmp_path / "archive" / "dedup_archive.json")
+    first_entry = _entry("a.mzML", "scan=1", _spectrum(0))
+    second_entry = _entry("b.mzML", "scan=1", _spectrum(1))
+
+    assert dedup_spectra.load_archive(archive_path) == []
+    assert dedup_spectra.commit_archive(archive_path, [first_entry]) == 1
+
+    # Already archived signatures are not added twice
+    assert dedup_spectra.commit_archive(archive_path, [first_entry, second_entry]) == 1
+
+    archive_entries = dedup_spectra.load_archive(archive_path)
+    assert [entry["filename"] for entry in archive_entries] == ["a.mzML", "b.mzML"]
+    assert all(entry["source"] == "archive" for entry in archive_entries)
+
+
+def test_find_metadata_duplicates():
+    metadata_df = pd.DataFrame({
+        "Filename ": ["a.mzML", "a.mzML", "b.mzML", "a.mzML", None],
+        "Scan/Coordinate": ["*", "*", "*", "B1", "*"],
+        "Strain name": ["S1", "S2", "S3", "S1", "S4"],
+    })
+
+    all_rows = dedup_spectra.find_metadata_duplicates(metadata_df)
+
+    assert len(all_rows) == 1
+    assert (all_rows[0]["filename"], all_rows[0]["scan"], all_rows[0]["status"]) == ("a.mzML", "*", "metadata_duplicate")
+    assert "row 0 (S1)" in all_rows[0]["duplicate_source"]
+    assert "row 1 (S2)" in all_rows[0]["duplicate_source"]
+
+    assert dedup_spectra.find_metadata_duplicates(pd.DataFrame({"Filename": ["a.mzML"]})) == []
+
+
+def _run_main(monkeypatch, input_folder, output_folder, archive_path):
+    output_report = str(output_folder / "duplicate_report.tsv")
+    output_candidates = str(output_folder / "dedup_candidates.json")
+    monkeypatch.setattr(sys, "argv", ["dedup_spectra.py", str(input_folder), output_report,
+                                      "--archive", archive_path, "--output_candidates", output_candidates])
+    dedup_spectra.main()
+
+    with open(output_report) as report_file:
+        all_rows = list(csv.DictReader(report_file, delimiter="\t"))
+
+    return [(row["filename"], row["scan"], row["status"], row["duplicate_source"]) for row in all_rows], json.load(open(output_candidates))
+
+
+def test_archive_only_changes_once_committed(tmp_path, monkeypatch):
+    input_folder = tmp_path / "merged"
+    input_folder.mkdir()
+    write_mzml(str(input_folder / "a.mzML"), [(MZ_ARRAY, _spectrum(0), "float64", True), (MZ_ARRAY, _spectrum(1), "float64", True)])
+    write_mzml(str(input_folder / "b.mzML"), [(MZ_ARRAY, _spectrum(0), "float64", True)])
+    archive_path = str(tmp_path / "dedup_archive.json")
+
+    all_rows, candidate_entries = _run_main(monkeypatch, input_folder, tmp_path, archive_path)
+    assert all_rows == [
+        ("a.mzML", "scan=1", "unique", ""),
+        ("a.mzML", "scan=2", "unique", ""),
+        ("b.mzML", "scan=1", "exact_duplicate", "submission"),
+    ]
+    assert len(candidate_entries) == 2
+
+    # A retry before the deposition finished does not see its own spectra in the archive
+    retry_rows, retry_candidates = _run_main(monkeypatch, input_folder, tmp_path, archive_path)
+    assert retry_rows == all_rows
+    assert dedup_spectra.load_archive(archive_path) == []
+
+    dedup_spectra.commit_archive(archive_path, retry_candidates)
+
+    archived_rows, archived_candidates = _run_main(monkeypatch, input_folder, tmp_path, archive_path)
+    assert [row[2:] for row in archived_rows] == [("exact_duplicate", "archive")] * 3
+    assert archived_candidates == []
@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+
+import deposit_spectra
+from existing_names import ExistingNames
+
+METADATA_ROW = {
+    "Filename": "a.mzML",
+    "Scan/Coordinate": "*",
+    "Strain name": "Strain A",
+    "MALDI matrix name": "HCCA",
+    "MALDI prep": "Direct",
+    "Cultivation media": "ISP2",
+    "Cultivation temp": "30",
+    "Cultivation time": "48h",
+    "PI": "PI name",
+}
+
+
+def _write_metadata(tmp_path, all_rows):
+    metadata_path = str(tmp_path / "metadata.tsv")
+    pd.DataFrame(all_rows).to_csv(metadata_path, sep="\t", index=False)
+    return metadata_path
+
+
+def test_valid_metadata(tmp_path):
+    metadata_path = _write_metadata(tmp_path, [METADATA_ROW, dict(METADATA_ROW, Filename="b.mzML")])
+
+    deposit_spectra._validate_metadata(metadata_path, ExistingNames([]))
+
+
+def test_missing_column_fails_before_upload(tmp_path):
+    metadata_path = _write_metadata(tmp_path, [{k: v for k, v in METADATA_ROW.items() if k != "PI"}])
+
+    with pytest.raises(Exception, match="PI"):
+        deposit_spectra._validate_metadata(metadata_path, ExistingNames([]))
+
+
+def test_pipelined_uploads_every_record():
+    all_records = [dict(METADATA_ROW, spectrum=[[2000.0, 1.0]], Filename="{}.mzML".format(index)) for index in range(20)]
+    # Records without a spectrum are skipped, e.g. a scan that was not found
+    all_records.append(dict(METADATA_ROW))
+
+    uploaded_filenames = []
+    deposit_spectra._deposit_pipelined(all_records, lambda spectrum_obj: uploaded_filenames.append(spectrum_obj["Filename"]),
+                                       queue_size=2, upload_workers=3)
+
+    assert sorted(uploaded_filenames) == sorted(record["Filename"] for record in all_records[:20])
+
+
+def test_pipelined_stops_after_upload_error():
+    all_records = [dict(METADATA_ROW, spectrum=[], Filename="{}.mzML".format(index)) for index in range(20)]
+
+    def _deposit(spectrum_obj):
+        raise ValueError("upload failed")
+
+    with pytest.raises(ValueError, match="upload failed"):
+        deposit_spectra._deposit_pipelined(all_records, _deposit, queue_size=2, upload_workers=2)
@@ -0,0 +1,87 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+import existing_names
+
+ETAG = '"names-v1"'
+NAMES = ["Strain A", "Strain B"]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.all_requests.append(dict(self.headers))
+
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        payload = json.dumps(NAMES).encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = HTTPServer(("127.0.0.1", 0), StubHandler)
+    server.all_requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server):
+    return "http://127.0.0.1:{}/api/get_all_strain_names".format(server.server_address[1])
+
+
+def test_download_not_modified_ttl_and_fallback(stub_server, tmp_path):
+    cache_path = str(tmp_path / "cache" / "existing_names.json")
+    url = _url(stub_server)
+
+    # 200, the snapshot is downloaded and cached
+    assert existing_names.fetch_existing_names(url, cache_path=cache_path, ttl=0) == NAMES
+    assert len(stub_server.all_requests) == 1
+    assert json.load(open(cache_path))["etag"] == ETAG
+
+    # 304, the cached snapshot is revalidated
+    assert existing_names.fetch_existing_names(url, cache_path=cache_path, ttl=0) == NAMES
+    assert len(stub_server.all_requests) == 2
+    assert stub_server.all_requests[-1]["If-None-Match"] == ETAG
+
+    # Fresh snapshot, the server is not asked
+    assert existing_names.fetch_existing_names(url, cache_path=cache_path, ttl=3600) == NAMES
+    assert len(stub_server.all_requests) == 2
+
+    # Server gone, falling back on the cached snapshot
+    stub_server.shutdown()
+    stub_server.server_close()
+    assert existing_names.fetch_existing_names(url, cache_path=cache_path, ttl=0, timeout=1, retries=2, backoff=0) == NAMES
+
+
+def test_cache_of_another_url_is_ignored(stub_server, tmp_path):
+    cache_path = str(tmp_path / "existing_names.json")
+    other_url = _url(stub_server).replace("/api/", "/other/api/")
+    existing_names._write_cache(cache_path, {"url": other_url, "etag": ETAG, "last_modified": None, "fetched_at": 0, "names": ["Other"]})
+
+    # Not revalidated with the other server's ETag, downloaded instead
+    assert existing_names.fetch_existing_names(_url(stub_server), cache_path=cache_path, ttl=3600) == NAMES
+    assert not "If-None-Match" in stub_server.all_requests[-1]
+
+    # Nor is it a fallback for another, unreachable server
+    with pytest.raises(requests.RequestException):
+        existing_names.fetch_existing_names(other_url.replace(str(stub_server.server_address[1]), "1"), cache_path=cache_path, ttl=3600, timeout=1, retries=1, backoff=0)
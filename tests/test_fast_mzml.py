@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from pyteomics import mzml
+
+import fast_mzml
+from mzml_helpers import write_mzml
+
+
+def _random_spectra():
+    rng = np.random.default_rng(0)
+    all_spectra = []
+    for dtype, compressed in [("float64", True), ("float32", False), ("float32", True), ("float64", False)]:
+        mz_array = np.sort(rng.uniform(2000, 20000, 500))
+        all_spectra.append((mz_array, rng.uniform(0, 1e5, 500), dtype, compressed))
+
+    # Empty spectrum
+    all_spectra.append((np.array([]), np.array([]), "float32", True))
+
+    return all_spectra
+
+
+def _assert_same_spectra(all_spectra, all_expected_spectra):
+    assert len(all_spectra) == len(all_expected_spectra)
+    for spectrum, expected_spectrum in zip(all_spectra, all_expected_spectra):
+        assert spectrum["id"] == expected_spectrum["id"]
+        assert spectrum["index"] == expected_spectrum["index"]
+        for array_name in ["m/z array", "intensity array"]:
+            assert spectrum[array_name].dtype == expected_spectrum[array_name].dtype
+            np.testing.assert_array_equal(spectrum[array_name], expected_spectrum[array_name])
+
+
+def test_same_arrays_as_pyteomics(tmp_path):
+    input_filename = str(tmp_path / "spectra.mzML")
+    write_mzml(input_filename, _random_spectra())
+
+    with mzml.read(input_filename) as reader:
+        all_expected_spectra = list(reader)
+
+    _assert_same_spectra(fast_mzml.read_spectra(input_filename), all_expected_spectra)
+
+
+def test_param_group_falls_back_on_pyteomics(tmp_path):
+    input_filename = str(tmp_path / "spectra.mzML")
+    all_spectra = _random_spectra()
+    write_mzml(input_filename, all_spectra, mz_param_group=True)
+
+    with pytest.raises(fast_mzml.UnsupportedMzMLError):
+        fast_mzml.read_spectra(input_filename)
+
+    with mzml.read(input_filename) as reader:
+        all_expected_spectra = list(reader)
+
+    all_loaded_spectra = list(fast_mzml.load_spectra(input_filename))
+    _assert_same_spectra(all_loaded_spectra, all_expected_spectra)
+    np.testing.assert_array_equal(all_loaded_spectra[0]["m/z array"], all_spectra[0][0])
+
+
+def test_small_batches(tmp_path):
+    input_filename = str(tmp_path / "spectra.mzML")
+    write_mzml(input_filename, _random_spectra())
+
+    with mzml.read(input_filename) as reader:
+        all_expected_spectra = list(reader)
+
+    _assert_same_spectra(list(fast_mzml.iter_spectra(input_filename, batch_size=2)), all_expected_spectra)
+
+
+def test_fallback_after_first_batches(tmp_path):
+    input_filename = str(tmp_path / "spectra.mzML")
+    write_mzml(input_filename, _random_spectra(), mz_param_group=True, param_group_from=3)
+
+    with mzml.read(input_filename) as reader:
+        all_expected_spectra = list(reader)
+
+    # The first batch is yielded by the fast reader, pyteomics continues without repeating it
+    _assert_same_spectra(list(fast_mzml.load_spectra(input_filename, batch_size=2)), all_expected_spectra)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from feature_matrix import write_feature_matrix, load_feature_matrix
+
+
+def _write_rows(output_filename):
+    all_row_bins = [np.array([120, 35, 700]), np.array([], dtype=np.int64), np.array([35, 410])]
+    all_row_values = [np.array([3.0, 1.5, 8.0]), np.array([], dtype=np.float64), np.array([2.0, 4.5])]
+    write_feature_matrix(output_filename, ["a.mzML", "a.mzML", "b.mzML"], [1, 2, "merged"],
+                         ["scan=1", "scan=2", "scan=1"], all_row_bins, all_row_values, 10.0)
+
+
+def _dense(feature_matrix):
+    dense = np.zeros(feature_matrix["shape"])
+    for row_index in range(feature_matrix["shape"][0]):
+        start, end = feature_matrix["indptr"][row_index], feature_matrix["indptr"][row_index + 1]
+        dense[row_index, feature_matrix["indices"][start:end]] = feature_matrix["data"][start:end]
+    return dense
+
+
+def test_memmap_round_trip(tmp_path):
+    output_filename = str(tmp_path / "feature_matrix.npz")
+    _write_rows(output_filename)
+
+    feature_matrix = load_feature_matrix(output_filename, mmap=True)
+
+    for key in ["data", "indices", "indptr"]:
+        assert isinstance(feature_matrix[key], np.memmap)
+
+    assert feature_matrix["shape"] == (3, 4)
+    assert feature_matrix["format"] == "csr"
+    np.testing.assert_array_equal(feature_matrix["column_bin"], [35, 120, 410, 700])
+    np.testing.assert_array_equal(feature_matrix["column_mz"], [350.0, 1200.0, 4100.0, 7000.0])
+    np.testing.assert_array_equal(feature_matrix["row_scan"], ["1", "2", "merged"])
+    np.testing.assert_array_equal(_dense(feature_matrix), [
+        [1.5, 3.0, 0.0, 8.0],
+        [0.0, 0.0, 0.0, 0.0],
+        [2.0, 0.0, 4.5, 0.0],
+    ])
+
+    loaded_matrix = load_feature_matrix(output_filename, mmap=False)
+    for key in ["data", "indices", "indptr"]:
+        assert not isinstance(loaded_matrix[key], np.memmap)
+        np.testing.assert_array_equal(loaded_matrix[key], feature_matrix[key])
+
+
+def test_same_as_scipy(tmp_path):
+    sparse = pytest.importorskip("scipy.sparse")
+
+    output_filename = str(tmp_path / "feature_matrix.npz")
+    _write_rows(output_filename)
+
+    feature_matrix = load_feature_matrix(output_filename)
+    scipy_matrix = sparse.load_npz(output_filename)
+
+    assert scipy_matrix.shape == feature_matrix["shape"]
+    np.testing.assert_array_equal(scipy_matrix.toarray(), _dense(feature_matrix))
+
+
+def test_empty_matrix(tmp_path):
+    output_filename = str(tmp_path / "feature_matrix.npz")
+    write_feature_matrix(output_filename, [], [], [], [], [], 10.0)
+
+    feature_matrix = load_feature_matrix(output_filename)
+
+    assert feature_matrix["shape"] == (0, 0)
+    assert len(feature_matrix["data"]) == 0
+    np.testing.assert_array_equal(feature_matrix["indptr"], [0])
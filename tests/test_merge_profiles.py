@@ -0,0 +1,69 @@
+import json
+import sys
+
+import merge_profiles
+import task_profile
+
+
+def _profile(task, wall_seconds, peak_rss_mb, stages, counters):
+    return {
+        "task": task,
+        "hostname": "node",
+        "wall_seconds": wall_seconds,
+        "peak_rss_mb": peak_rss_mb,
+        "stages": {stage: {"seconds": seconds, "calls": calls} for stage, (seconds, calls) in stages.items()},
+        "counters": counters
+    }
+
+
+def test_aggregate_profiles():
+    all_profiles = [
+        _profile("processing_spectra", 10.0, 100.0, {"parse": (4.0, 2), "encode": (1.0, 5)}, {"scans": 5, "peaks": 50}),
+        _profile("processing_spectra", 20.0, 300.0, {"parse": (6.0, 3)}, {"scans": 7}),
+        _profile("deposit_spectra", 5.0, None, {"upload": (3.0, 12)}, {"spectra": 12}),
+    ]
+
+    run_report = merge_profiles.aggregate_profiles(all_profiles)
+
+    assert run_report["profile_count"] == 3
+    assert run_report["total_task_seconds"] == 35.0
+
+    processing_summary = run_report["tasks"]["processing_spectra"]
+    assert processing_summary["task_count"] == 2
+    assert processing_summary["wall_seconds"] == 30.0
+    assert processing_summary["max_wall_seconds"] == 20.0
+    assert processing_summary["max_peak_rss_mb"] == 300.0
+    assert processing_summary["stages"] == {"parse": {"seconds": 10.0, "calls": 5}, "encode": {"seconds": 1.0, "calls": 5}}
+    assert processing_summary["counters"] == {"scans": 12, "peaks": 50}
+
+    # Missing memory measurements are skipped rather than compared
+    assert run_report["tasks"]["deposit_spectra"]["max_peak_rss_mb"] == 0.0
+
+    stage_rows = merge_profiles.get_stage_rows(all_profiles)
+    assert len(stage_rows) == 4
+    assert list(stage_rows["stage"]) == ["parse", "encode", "parse", "upload"]
+
+
+def test_main_reads_task_profiles(tmp_path, monkeypatch):
+    input_folder = tmp_path / "profiles"
+    input_folder.mkdir()
+
+    task_profile.reset()
+    with task_profile.timer("parse"):
+        pass
+    task_profile.count("scans", 3)
+    task_profile.write_profile(str(input_folder / "profile_1.json"), "merge_spectra")
+    task_profile.reset()
+
+    (input_folder / "profile_2.json").write_text("not json")
+
+    output_json = tmp_path / "run_profile.json"
+    output_tsv = tmp_path / "run_profile_stages.tsv"
+    monkeypatch.setattr(sys, "argv", ["merge_profiles.py", str(input_folder), str(output_json), str(output_tsv)])
+    merge_profiles.main()
+
+    run_report = json.load(open(output_json))
+    assert run_report["profile_count"] == 1
+    assert run_report["tasks"]["merge_spectra"]["counters"] == {"scans": 3}
+    assert run_report["tasks"]["merge_spectra"]["stages"]["parse"]["calls"] == 1
+    assert len(open(output_tsv).read().strip().split("\n")) == 2
@@ -0,0 +1,57 @@
+import numpy as np
+
+from peak_reduction import reduce_peaks
+
+ALL_TRUE_PEAKS = [(4000.0, 3000.0), (7000.0, 1500.0), (11000.0, 2500.0), (15000.0, 1200.0)]
+
+
+def _synthetic_spectrum(seed, noise_model):
+    # Exponential MALDI like baseline with four Gaussian peaks
+    rng = np.random.default_rng(seed)
+    mz_array = np.linspace(2000, 20000, 20000)
+    baseline = 20000 * np.exp(-(mz_array - 2000) / 2500) + 200
+    signal = baseline + sum(height * np.exp(-0.5 * ((mz_array - center) / 10) ** 2) for center, height in ALL_TRUE_PEAKS)
+
+    if noise_model == "poisson":
+        intensity_array = rng.poisson(signal).astype(float)
+    else:
+        intensity_array = signal + rng.normal(0, 30, len(mz_array))
+
+    return np.column_stack([mz_array, intensity_array]).tolist(), baseline
+
+
+def _is_true_peak(peak):
+    return any(abs(peak[0] - center) < 15 for center, height in ALL_TRUE_PEAKS)
+
+
+def test_finds_the_peaks_above_a_sloped_baseline():
+    for noise_model in ["poisson", "gaussian"]:
+        for seed in range(3):
+            peaks_list, baseline = _synthetic_spectrum(seed, noise_model)
+
+            reduced_peaks_list = reduce_peaks(peaks_list, snr=4)
+
+            for center, height in ALL_TRUE_PEAKS:
+                assert any(abs(peak[0] - center) < 15 for peak in reduced_peaks_list), (noise_model, seed, center)
+
+            # Only occasional 4 sigma noise maxima, out of 20000 points
+            false_peaks = [peak for peak in reduced_peaks_list if not _is_true_peak(peak)]
+            assert len(false_peaks) <= 3, (noise_model, seed, false_peaks)
+
+
+def test_keeps_raw_apex_intensity():
+    peaks_list, baseline = _synthetic_spectrum(0, "gaussian")
+    raw_intensities = dict((mz, intensity) for mz, intensity in peaks_list)
+
+    for mz, intensity in reduce_peaks(peaks_list, snr=4):
+        assert intensity == raw_intensities[mz]
+
+
+def test_top_n_and_min_intensity():
+    peaks_list, baseline = _synthetic_spectrum(0, "poisson")
+
+    top_peaks = reduce_peaks(peaks_list, snr=4, top_n=2)
+    assert [round(peak[0] / 1000) for peak in top_peaks] == [4, 11]
+
+    assert all(peak[1] >= 2000 for peak in reduce_peaks(peaks_list, snr=4, min_intensity=2000))
+    assert reduce_peaks([], snr=4) == []
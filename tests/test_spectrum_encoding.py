@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import spectrum_encoding
+
+
+def _peaks_list():
+    rng = np.random.default_rng(0)
+    mz_array = np.sort(rng.uniform(2000, 20000, 1000))
+    return np.column_stack([mz_array, rng.uniform(0, 1e6, 1000)]).tolist()
+
+
+@pytest.mark.parametrize("intensity_precision", ["32", "64"])
+@pytest.mark.parametrize("compression", ["zlib", "none"])
+@pytest.mark.parametrize("mz_delta", [False, True])
+def test_round_trip(intensity_precision, compression, mz_delta):
+    peaks_list = _peaks_list()
+
+    encoded_spectrum = spectrum_encoding.encode_peaks(peaks_list, intensity_precision=intensity_precision, compression=compression, mz_delta=mz_delta)
+    decoded_peaks_list = spectrum_encoding.decode_peaks(encoded_spectrum)
+
+    assert encoded_spectrum["peak_count"] == len(peaks_list)
+    assert encoded_spectrum["mz_dtype"] == "float64"
+
+    mz_array, intensity_array = np.array(peaks_list).T
+    decoded_mz_array, decoded_intensity_array = np.array(decoded_peaks_list).T
+
+    if mz_delta:
+        np.testing.assert_allclose(decoded_mz_array, mz_array, rtol=0, atol=1e-9)
+    else:
+        # m/z is stored as 64 bit floats so it comes back exactly
+        assert decoded_mz_array.tolist() == mz_array.tolist()
+
+    if intensity_precision == "64":
+        assert decoded_intensity_array.tolist() == intensity_array.tolist()
+    else:
+        assert decoded_intensity_array.tolist() == intensity_array.astype(np.float32).astype(np.float64).tolist()
+
+
+@pytest.mark.parametrize("mz_delta", [False, True])
+def test_empty_spectrum(mz_delta):
+    encoded_spectrum = spectrum_encoding.encode_peaks([], mz_delta=mz_delta)
+
+    assert encoded_spectrum["peak_count"] == 0
+    assert spectrum_encoding.decode_peaks(encoded_spectrum) == []
+
+
+def test_record_round_trip():
+    peaks_list = _peaks_list()
+    record = {"Filename": "a.mzML", "spectrum": [peaks_list, []]}
+
+    spectrum_encoding.encode_record(record)
+    assert record["Spectrum encoding"] == spectrum_encoding.BINARY_ENCODING
+
+    # Encoding twice leaves the record as it is
+    assert spectrum_encoding.encode_record(record)["spectrum"][0]["peak_count"] == len(peaks_list)
+
+    spectrum_encoding.decode_record(record)
+    assert not "Spectrum encoding" in record
+    assert [peak[0] for peak in record["spectrum"][0]] == [peak[0] for peak in peaks_list]
+    assert record["spectrum"][1] == []
+
+
+def test_invalid_options():
+    with pytest.raises(ValueError):
+        spectrum_encoding.encode_peaks(_peaks_list(), intensity_precision="16")
+    with pytest.raises(ValueError):
+        spectrum_encoding.encode_peaks(_peaks_list(), compression="gzip")